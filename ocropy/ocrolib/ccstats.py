@@ -0,0 +1,110 @@
+################################################################
+### Statistics of connected components, computed for all the
+### components of a labeled image at once.
+################################################################
+
+from numpy import *
+import morph
+
+# The statistics are kept in arrays indexed by label, so that they
+# can be computed and used without looping over the components in
+# Python.  Entry 0 corresponds to the background and is not a
+# component; its bounding box is empty.
+
+class ComponentStats:
+    """Areas, bounding boxes, and sizes of all the connected components
+    of a labeled image.  The arrays are indexed by label: `y0`, `x0`,
+    `y1`, `x1` are the bounds (as for slices), `heights` and `widths`
+    the dimensions, and `areas` the areas of the bounding boxes.
+    The pixel counts are only computed on demand (`counts`)."""
+    def __init__(self,labels,n=None):
+        if n is None: n = amax(labels) if labels.size>0 else 0
+        self.shape = labels.shape
+        self.n = n
+        self.labels = labels
+        objects = morph.find_objects(labels)[:n]
+        boxes = [(0,0,0,0)]+[(0,0,0,0) if o is None else
+                             (o[0].start,o[1].start,o[0].stop,o[1].stop) for o in objects]
+        boxes = array(boxes,'i').reshape(n+1,4)
+        self.y0,self.x0,self.y1,self.x1 = boxes.T
+        self.heights = self.y1-self.y0
+        self.widths = self.x1-self.x0
+        self.areas = self.heights*self.widths
+    def counts(self):
+        """The number of pixels of each component."""
+        return bincount(self.labels.ravel(),minlength=self.n+1)[:self.n+1]
+    def slices(self,i):
+        """The bounding box of component `i` as a tuple of slices."""
+        return (slice(self.y0[i],self.y1[i]),slice(self.x0[i],self.x1[i]))
+    def bysize(self):
+        """The labels of the components in order of increasing
+        bounding box area (ties in order of label)."""
+        return 1+argsort(self.areas[1:],kind='mergesort')
+
+def binary_stats(binary):
+    """Label the binary image and compute the statistics
+    of its connected components."""
+    labels,n = morph.label(binary)
+    return ComponentStats(labels,n)
+
+def cumsum_rows(a):
+    """Cumulative sums along axis 0 of a 2D array, in place.  The rows
+    are added up one at a time, which is much faster than `cumsum`
+    along axis 0 for large images."""
+    for y in range(1,len(a)): a[y] += a[y-1]
+    return a
+
+def cumsum2(a):
+    """Cumulative sums along both axes of a 2D array, in place."""
+    cumsum_rows(a)
+    cumsum(a,axis=1,out=a)
+    return a
+
+def box_coverage(stats,which=None):
+    """For each pixel, count the bounding boxes of the components in
+    `which` (default all) that contain it.  All the boxes are painted
+    at once using a difference image."""
+    if which is None: which = arange(1,stats.n+1)
+    which = asarray(which,'i')
+    h,w = stats.shape
+    y0,x0,y1,x1 = [a[which] for a in (stats.y0,stats.x0,stats.y1,stats.x1)]
+    corners = concatenate([y0*(w+1)+x0,y1*(w+1)+x1,y0*(w+1)+x1,y1*(w+1)+x0])
+    signs = concatenate([ones(2*len(which)),-ones(2*len(which))])
+    keys,inverse = unique(corners,return_inverse=True)
+    diffs = zeros((h+1)*(w+1),'i')
+    diffs[keys] = bincount(inverse,weights=signs)
+    diffs = diffs.reshape(h+1,w+1)
+    return cumsum2(diffs)[:h,:w]
+
+def box_sums(image,stats,which=None,dtype='i'):
+    """Sum the image over the bounding boxes of the components in `which`
+    (default all), using a summed area table of the given type."""
+    if which is None: which = arange(1,stats.n+1)
+    which = asarray(which,'i')
+    h,w = image.shape
+    table = zeros((h+1,w+1),dtype)
+    table[1:,1:] = image
+    cumsum2(table)
+    y0,x0,y1,x1 = [a[which] for a in (stats.y0,stats.x0,stats.y1,stats.x1)]
+    return table[y1,x1]-table[y0,x1]-table[y1,x0]+table[y0,x0]
+
+def disjoint_boxes(stats):
+    """Go through the components by increasing bounding box area and
+    keep each component whose bounding box doesn't overlap the box
+    of a component that was kept before.  Returns the kept labels in
+    order.  Components whose boxes don't overlap any other box are
+    always kept; only the remaining ones need to be checked in turn."""
+    order = stats.bysize()
+    # a box is isolated if it is covered only once; clipping the
+    # coverage keeps the sums small
+    coverage = minimum(box_coverage(stats,order),2)
+    isolated = zeros(stats.n+1,bool)
+    isolated[order] = (box_sums(coverage,stats,order)==stats.areas[order])
+    kept = isolated.copy()
+    taken = zeros(stats.shape,bool)
+    for i in order[~isolated[order]]:
+        o = stats.slices(i)
+        if taken[o].any(): continue
+        taken[o] = 1
+        kept[i] = 1
+    return order[kept[order]]
@@ -18,6 +18,7 @@ from pylab import imshow
 import psegutils
 from pylab import imshow
 import psegutils,morph
+import pack
 from toplevel import *
 
 pickle_mode = 2
@@ -41,8 +42,8 @@ def deprecated(f):
 import codecs
 
 def read_text(fname,nonl=1):
-    with codecs.open(fname,"r","utf-8") as stream:
-        result = stream.read()
+    with open_file(fname,"rb") as stream:
+        result = stream.read().decode("utf-8")
     if nonl and len(result)>0 and result[-1]=='\n':
         result = result[:-1]
     return result
@@ -59,6 +60,20 @@ def write_text(fname,text,nonl=0):
 
 import PIL
 
+def pil_open(fname):
+    """Open an image file (which may be in a pack) as a PIL image."""
+    if pack.split(fname) is None: return PIL.Image.open(fname)
+    return PIL.Image.open(open_file(fname,"rb"))
+
+def pil_save(im,fname):
+    """Save a PIL image to a file (which may be in a pack); the
+    format is determined by the extension."""
+    if pack.split(fname) is None: return im.save(fname)
+    PIL.Image.init()
+    format = PIL.Image.EXTENSION[os.path.splitext(fname)[1].lower()]
+    with open_file(fname,"wb") as stream:
+        im.save(stream,format)
+
 def pil2array(im,alpha=0):
     if im.mode=="L":
         a = numpy.fromstring(im.tostring(),'B')
@@ -100,29 +115,38 @@ def isintarray(a):
 def isintegerarray(a):
     return a.dtype in [dtype('int32'),dtype('int64'),dtype('uint32'),dtype('uint64')]
 
-@checks(str,pageno=int,_=GRAYSCALE)
-def read_image_gray(fname,pageno=0):
+@checks({str,tuple},pageno=int,_=ANY(GRAYSCALE,BYTEIMAGE))
+def read_image_gray(fname,pageno=0,dtype='d'):
     """Read an image and returns it as a floating point array.
     The optional page number allows images from files containing multiple
-    images to be addressed.  Byte and short arrays are rescaled to
-    the range 0...1 (unsigned) or -1...1 (signed)."""
-    if type(fname)==tuple: fname,pageno = fname
-    assert pageno==0
-    pil = PIL.Image.open(fname)
+    images (or from archives of images) to be addressed; `fname` can
+    also be a (fname,pageno) tuple, as returned by `page_list`.  Byte
+    and short arrays are rescaled to the range 0...1 (unsigned) or
+    -1...1 (signed).  With `dtype='f'`,
+    the image is converted and rescaled in single precision; with
+    `dtype='B'`, a byte image is returned as decoded, without rescaling
+    (color images are averaged as bytes)."""
+    pil = open_page(fname,pageno)
     a = pil2array(pil)
-    if a.dtype==dtype('uint8'):
-        a = a/255.0
-    if a.dtype==dtype('int8'):
-        a = a/127.0
-    elif a.dtype==dtype('uint16'):
-        a = a/65536.0
-    elif a.dtype==dtype('uint16'):
-        a = a/32767.0
+    if numpy.dtype(dtype)==numpy.dtype('B'):
+        assert a.dtype==numpy.dtype('B'),"not a byte image: %s"%a.dtype
+        if a.ndim==3: a = array(mean(a,2,dtype='f')+0.5,'B')
+        return a
+    if a.dtype==numpy.dtype('uint8'):
+        scale = 255.0
+    elif a.dtype==numpy.dtype('int8'):
+        scale = 127.0
+    elif a.dtype==numpy.dtype('uint16'):
+        scale = 65536.0
+    elif a.dtype==numpy.dtype('int16'):
+        scale = 32767.0
     elif isfloatarray(a):
-        pass
+        scale = 1.0
     else:
-        raise Exception("unknown image type: "+a.dtype)
-    if a.ndim==3: 
+        raise Exception("unknown image type: "+str(a.dtype))
+    a = array(a,dtype)
+    if scale!=1.0: a /= scale
+    if a.ndim==3:
         a = mean(a,2)
     return a
 
@@ -136,18 +160,20 @@ def write_image_gray(fname,image,normalize=0):
         image = array(255*clip(image,0.0,1.0),'B')
     assert image.dtype==dtype('B'),"array has wrong dtype: %s"%image.dtype
     im = array2pil(image)
-    im.save(fname)
+    pil_save(im,fname)
 
-@checks(str,_=ABINARY2)
+@checks({str,tuple},_=ABINARY2)
 def read_image_binary(fname,dtype='i',pageno=0):
-    """Read an image from disk and return it as a binary image
-    of the given dtype."""
-    if type(fname)==tuple: fname,pageno = fname
-    assert pageno==0
-    pil = PIL.Image.open(fname)
+    """Read an image (or a page, as for read_image_gray) from disk
+    and return it as a binary image of the given dtype.  Use `dtype='B'` (or `bool`) for compact
+    images that are used without conversion by the page segmenter."""
+    pil = open_page(fname,pageno)
     a = pil2array(pil)
     if a.ndim==3: a = amax(a,axis=2)
-    return array(a>0.5*(amin(a)+amax(a)),dtype)
+    a = (a>0.5*(amin(a)+amax(a)))
+    # boolean images can be reinterpreted as bytes without a copy
+    if numpy.dtype(dtype) in [numpy.dtype(bool),numpy.dtype('B')]: return a.view(dtype)
+    return array(a,dtype)
 
 @checks(str,ABINARY2)
 def write_image_binary(fname,image):
@@ -157,7 +183,7 @@ def write_image_binary(fname,image):
     assert image.ndim==2
     image = array(255*(image>midrange(image)),'B')
     im = array2pil(image)
-    im.save(fname)
+    pil_save(im,fname)
 
 @checks(AINT3,_=AINT2)
 def rgb2int(a):
@@ -197,7 +223,7 @@ def make_seg_white(image):
 def read_line_segmentation(fname):
     """Reads a line segmentation, that is an RGB image whose values
     encode the segmentation of a text line.  Returns an int array."""
-    pil = PIL.Image.open(fname)
+    pil = pil_open(fname)
     a = pil2array(pil)
     assert a.dtype==dtype('B')
     assert a.ndim==3
@@ -211,13 +237,13 @@ def write_line_segmentation(fname,image):
     encode the segmentation of a text line."""
     a = int2rgb(make_seg_white(image))
     im = array2pil(a)
-    im.save(fname)
+    pil_save(im,fname)
 
 @checks(str,_=PAGESEG)
 def read_page_segmentation(fname):
     """Reads a page segmentation, that is an RGB image whose values
     encode the segmentation of a page.  Returns an int array."""
-    pil = PIL.Image.open(fname)
+    pil = pil_open(fname)
     a = pil2array(pil)
     assert a.dtype==dtype('B')
     assert a.ndim==3
@@ -233,12 +259,115 @@ def write_page_segmentation(fname,image):
     assert image.dtype in [dtype('int32'),dtype('int64')]
     a = int2rgb(make_seg_white(image))
     im = array2pil(a)
-    im.save(fname)
+    pil_save(im,fname)
 
-def iulib_page_iterator(files):
+################################################################
+### Multi-page input.  Besides single images, the page functions
+### accept multi-page images (e.g., TIFF) and zip and tar archives
+### of images.  The pages of such files are addressed as (fname,pageno)
+### tuples, which can be passed to read_image_gray and read_image_binary,
+### and are only decoded when they are read.
+################################################################
+
+import zipfile,tarfile,StringIO
+
+archive_extensions = [".zip",".tar",".tar.gz",".tgz",".tar.bz2",".tbz2"]
+image_extensions = [".png",".jpg",".jpeg",".tif",".tiff",".pbm",".pgm",".ppm",".pnm",".bmp",".gif"]
+
+def is_archive(fname):
+    """Whether the file is a zip or tar archive (judging by its extension)."""
+    return any([fname.lower().endswith(e) for e in archive_extensions])
+
+# the open archives, by file name and process (open files
+# must not be shared between the processes of a pool)
+archive_cache = {}
+
+def archive_members(fname):
+    """Return the (cached) open archive and the sorted list of
+    the names of the images it contains."""
+    key = (fname,os.getpid())
+    if key not in archive_cache:
+        if fname.lower().endswith(".zip"):
+            archive = zipfile.ZipFile(fname)
+            names = archive.namelist()
+        else:
+            archive = tarfile.open(fname)
+            names = [m.name for m in archive.getmembers() if m.isfile()]
+        names = sorted([n for n in names if os.path.splitext(n)[1].lower() in image_extensions])
+        archive_cache[key] = (archive,names)
+    return archive_cache[key]
+
+def open_page(fname,pageno=0):
+    """Open a page of an image file or an archive of images as
+    a PIL image.  Only the page's header is read at this point."""
+    if type(fname)==tuple: fname,pageno = fname
+    if is_archive(fname):
+        archive,names = archive_members(fname)
+        if pageno>=len(names): raise IndexError("%s: no page %d"%(fname,pageno))
+        if isinstance(archive,zipfile.ZipFile):
+            data = archive.read(names[pageno])
+        else:
+            data = archive.extractfile(names[pageno]).read()
+        return PIL.Image.open(StringIO.StringIO(data))
+    pil = pil_open(fname)
+    if pageno>0:
+        try:
+            pil.seek(pageno)
+        except EOFError:
+            raise IndexError("%s: no page %d"%(fname,pageno))
+    return pil
+
+def count_pages(fname):
+    """The number of pages in an image file or an archive of images."""
+    if is_archive(fname): return len(archive_members(fname)[1])
+    pil = pil_open(fname)
+    n = 1
+    try:
+        while 1:
+            pil.seek(n)
+            n += 1
+    except EOFError:
+        pass
+    return n
+
+def page_list(files):
+    """Expand a list of files into a list of pages.  Single images
+    are left as they are, while multi-page images and archives are
+    expanded into (fname,pageno) tuples.  No pages are decoded."""
+    pages = []
     for fname in files:
-        image = read_image_gray(fname)
-        yield image,fname
+        n = count_pages(fname)
+        if is_archive(fname) or n>1:
+            pages += [(fname,i) for i in range(n)]
+        else:
+            pages.append(fname)
+    return pages
+
+def page_base(page):
+    """The base name for the files derived from a page, e.g., "book"
+    for "book.png", and "book-0003" for the third page of "book.tif"
+    or "book.zip"."""
+    if type(page)==tuple:
+        fname,pageno = page
+        return "%s-%04d"%(allsplitext(fname)[0],pageno+1)
+    return allsplitext(page)[0]
+
+def page_name(page):
+    """A printable name for a page, e.g., "book.tif[2]" for the
+    third page of "book.tif"."""
+    if type(page)==tuple: return "%s[%d]"%page
+    return page
+
+def page_iterator(files,dtype='d'):
+    """Iterate over the pages of the given files (see `page_list`),
+    yielding (image,page) pairs.  Each page is only decoded when
+    it is reached."""
+    for page in page_list(files):
+        yield read_image_gray(page,dtype=dtype),page
+
+def iulib_page_iterator(files):
+    for image,page in page_iterator(files):
+        yield image,page_name(page)
 
 class RegionExtractor:
     """A class facilitating iterating over the parts of a segmentation."""
@@ -496,7 +625,7 @@ def base(path):
 @checks(str,{str,unicode})
 def write_text(file,s):
     """Write the given string s to the output file."""
-    with open(file,"w") as stream:
+    with open_file(file,"w") as stream:
         if type(s)==unicode: s = s.encode("utf-8")
         stream.write(s)
 
@@ -505,7 +634,7 @@ def glob_all(args):
     """Given a list of command line arguments, expand all of them with glob."""
     result = []
     for arg in args:
-        expanded = sorted(glob.glob(arg))
+        expanded = sorted(pack.glob(arg))
         if len(expanded)<1:
             raise Exception("%s: expansion did not yield any files"%arg)
         result += expanded
@@ -516,8 +645,8 @@ def expand_args(args):
     """Given a list of command line arguments, if the
     length is one, assume it's a book directory and expands it.
     Otherwise returns the arguments unchanged."""
-    if len(args)==1 and os.path.isdir(args[0]):
-        return sorted(glob.glob(args[0]+"/????/??????.png"))
+    if len(args)==1 and fisdir(args[0]):
+        return sorted(fglob(args[0]+"/????/??????.png"))
     else:
         return args
 
@@ -549,11 +678,35 @@ def ocropus_find_file(fname):
         if os.path.exists(full): return full
     raise OcropusFileNotFound(fname)
 
+################################################################
+### File access.  Paths going through a pack file (e.g.,
+### "book.pack/0001/010001.bin.png") refer to files in the pack
+### (see ocrolib.pack); these functions work for both kinds
+### of paths.
+################################################################
+
+def open_file(fname,mode="r"):
+    """Open a file (which may be in a pack), like `open`."""
+    return pack.open_file(fname,mode)
+
 def fexists(fname):
     """Returns fname if it exists, otherwise None."""
-    if os.path.exists(fname): return fname
+    if pack.exists(fname): return fname
     return None
 
+def fisdir(path):
+    """Whether the path is a directory (or a directory in a pack)."""
+    return pack.isdir(path)
+
+def fmkdir(path):
+    """Create a directory unless it exists (nothing needs
+    to be created for directories in packs)."""
+    pack.makedirs(path)
+
+def fglob(pattern):
+    """Like glob.glob, but also finds files in packs."""
+    return pack.glob(pattern)
+
 def fvariant(fname,kind,gt=""):
     """Find the file variant corresponding to the given file name.
     Possible fil variants are line (or png), rseg, cseg, fst, costs, and txt.
@@ -601,13 +754,13 @@ def ffind(fname,kind,gt=None):
     """Like fvariant, but throws an IOError if the file variant
     doesn't exist."""
     s = fvariant(fname,kind,gt=gt)
-    if not os.path.exists(s):
+    if not fexists(s):
         raise IOError(s)
     return s
 
 def fopen(fname,kind,gt=None,mode="r"):
     """Like fvariant, but opens the file."""
-    return open(fvariant(fname,kind,gt),mode)
+    return open_file(fvariant(fname,kind,gt),mode)
 
 ################################################################
 ### Utility for setting "parameters" on an object: a list of keywords for
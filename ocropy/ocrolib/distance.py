@@ -1,97 +1,110 @@
 ################################################################
-### Native code neural network with backpropagation training.
+### Euclidean distances and nearest neighbors between sets of vectors.
 ################################################################
 
 from __future__ import with_statement
 
-__all__ = "MLP".split()
-
-import os,sys,os.path,re,math
-import copy as pycopy
-import random as pyrandom
-from random import sample as selection, shuffle, uniform
 from numpy import *
-from pylab import *
-from scipy import *
-import common as ocrolib
-from native import *
-import multiprocessing
 
-def c_order(a):
-    """Check whether the elements of the array are in C order."""
-    return tuple(a.strides)==tuple(sorted(a.strides,reverse=1))
+# The squared distances are computed as |a|^2+|b|^2-2 a.b, so that
+# the bulk of the work is a single matrix multiply (which BLAS performs
+# much faster than a loop over pairs of vectors).  Distances are computed
+# in blocks of rows of `a` containing at most `tilesize` distances,
+# to bound the memory used for temporaries.
 
-cdist_native_c = r'''
-#include <math.h>
-#include <stdio.h>
-#include <assert.h>
-#include <stdlib.h>
-#include <omp.h>
+tilesize = 4000000
 
-int maxthreads = 1;
+def sqnorms(a):
+    """Compute the squared norms of the rows of a 2D array."""
+    return sum(a*a,axis=1)
 
-void cdist(int d,int na,int nb,float a[na][d],float b[nb][d],float result[na][nb]) {
-    int n = na*nb;
-#pragma omp parallel for num_threads (maxthreads)
-    for(int job=0;job<n;job++) {
-        int i = job/nb;
-        int j = job%nb;
-        double total = 0.0;
-        for(int k=0;k<d;k++) {
-            float delta = a[i][k]-b[j][k];
-            total += delta*delta;
-        }
-        result[i][j] = sqrt(total);
-    }
-}
-'''
+def as2d(a,dtype=None):
+    a = asarray(a,dtype)
+    if a.ndim==1: a = a.reshape(1,-1)
+    assert a.ndim==2
+    return a
 
-cdist_native = None
+def tilerows(nb):
+    """Number of rows of `a` per tile for `nb` prototypes."""
+    return max(1,tilesize//max(1,nb))
 
-def cdist_native_load():
-    global cdist_native
-    if cdist_native is not None: return
-    cdist_native = compile_and_load(cdist_native_c)
-    cdist_native.cdist.argtypes = [I,I,I,A2F,A2F,A2F]
-    global maxthreads
-    maxthreads = c_int.in_dll(cdist_native,"maxthreads")
-    maxthreads.value = multiprocessing.cpu_count()
+def sqdists(a,b,bnorms=None):
+    """Compute the matrix of squared Euclidean distances between the
+    rows of `a` and the rows of `b`.  The squared norms of `b` can be passed
+    in if they are already known.  This doesn't tile; see `cdist`."""
+    a = as2d(a,'float64')
+    b = as2d(b,'float64')
+    assert a.shape[1]==b.shape[1]
+    if bnorms is None: bnorms = sqnorms(b)
+    d = dot(a,b.T)
+    d *= -2
+    d += sqnorms(a)[:,newaxis]
+    d += bnorms[newaxis,:]
+    # cancellation can make the distances of (nearly)
+    # identical vectors slightly negative
+    maximum(d,0,out=d)
+    return d
 
-def cdist(a,b,out=None,threads=-1):
-    cdist_native_load()
-    if type(a)==list or a.dtype!=dtype('float32') or not c_order(a):
-        a = array(a,dtype='float32',order="C")
-    if type(b)==list or b.dtype!=dtype('float32') or not c_order(b):
-        b = array(b,dtype='float32',order="C")
-    assert a.ndim==2
-    assert b.ndim==2
+def cdist(a,b,out=None,threads=-1,bnorms=None):
+    """Compute the matrix of Euclidean distances between the rows
+    of `a` and `b` (as float32).  The `threads` argument is only kept for
+    backwards compatibility; the number of threads used by the
+    matrix multiply is determined by the BLAS library."""
+    a = as2d(a)
+    b = as2d(b,'float64')
     assert a.shape[1]==b.shape[1]
-    na = len(a)
-    nb = len(b)
-    d = a.shape[1]
+    if bnorms is None: bnorms = sqnorms(b)
     if out is None:
         out = zeros((len(a),len(b)),'float32')
-    if threads<0: threads = multiprocessing.cpu_count()
-    maxthreads.value = threads
-    cdist_native.cdist(d,na,nb,a,b,out)
+    step = tilerows(len(b))
+    for i in range(0,len(a),step):
+        j = min(i+step,len(a))
+        out[i:j] = sqrt(sqdists(a[i:j],b,bnorms=bnorms))
     return out
 
+def knn(a,b,k,bnorms=None):
+    """For each row of `a`, find the indexes of the `k` nearest rows
+    of `b`, nearest first.  This uses partial selection rather than
+    sorting all the distances."""
+    a = as2d(a)
+    b = as2d(b,'float64')
+    k = min(k,len(b))
+    if bnorms is None: bnorms = sqnorms(b)
+    result = zeros((len(a),k),'i')
+    step = tilerows(len(b))
+    for i in range(0,len(a),step):
+        j = min(i+step,len(a))
+        d = sqdists(a[i:j],b,bnorms=bnorms)
+        if k==1:
+            result[i:j,0] = argmin(d,axis=1)
+            continue
+        if k<len(b):
+            js = argpartition(d,k-1,axis=1)[:,:k]
+        else:
+            js = repeat(arange(len(b))[newaxis,:],len(d),axis=0)
+        rows = arange(len(d))[:,newaxis]
+        order = argsort(d[rows,js],axis=1)
+        result[i:j] = js[rows,order]
+    return result
+
 class ProtoDists:
+    """Distances to a fixed set of prototypes; the squared
+    norms of the prototypes are computed only once."""
     def __init__(self):
         pass
     def setProtos(self,b):
         assert b.ndim==2
-        assert c_order(b)
-        if b.dtype!=dtype('float32'): b = array(b,'float32')
-        self.b = b
+        self.b = asarray(b,'float64')
+        self.bnorms = sqnorms(self.b)
+        return self
     def cdist(self,a):
-        if a.dtype!=dtype('float32'): a = array(a,'float32')
-        return cdist(a,self.b,threads=-1)
+        return cdist(a,self.b,bnorms=self.bnorms)
+    def knn(self,a,k):
+        return knn(a,self.b,k,bnorms=self.bnorms)
 
 if __name__=="__main__":
-    cdist_native_load()
-    a = array(randn(3,5),'f')
-    b = array(randn(7,5),'f')
+    a = array(random.randn(3,5),'f')
+    b = array(random.randn(7,5),'f')
     from scipy.spatial.distance import cdist as oldcdist
     out = cdist(a,b)
     print out
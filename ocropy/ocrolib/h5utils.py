@@ -41,8 +41,22 @@ def log(db,*args):
     import time
     db.setNodeAttr("/","LOG_%d"%int(time.time())," ".join(args))
 
-def create_earray(db,name,element_shape,type='f'):
+def create_earray(db,name,element_shape,type='f',**kw):
+    """Create an extendable array; additional keyword arguments
+    (e.g., `expectedrows`) are passed on to `createEArray`."""
     if type=='f' or type=='float32': atom = tables.Float32Atom()
     elif type=='i' or type=='float64': atom = tables.Int64Atom()
     else: raise Exception("unknown array type; choose one of: 'i', 'f'")
-    return db.createEArray(db.root,name,atom,shape=(0,)+tuple(element_shape),filters=tables.Filters(9))
+    return db.createEArray(db.root,name,atom,shape=(0,)+tuple(element_shape),filters=tables.Filters(9),**kw)
+
+def append_arrays(source,dest,names,chunksize=100000,verbose=1):
+    """Append the arrays `names` of `source` to the corresponding arrays
+    of `dest` (creating them if necessary), copying large chunks at a time."""
+    for name in names:
+        a = source.getNode("/"+name)
+        if name not in dir(dest.root):
+            dest.createEArray(dest.root,name,a.atom,shape=(0,)+a.shape[1:],filters=tables.Filters(9))
+        b = dest.getNode("/"+name)
+        if verbose: print "[appending",name,a.shape,"to",b.shape,"]"
+        for i in range(0,len(a),chunksize):
+            b.append(a[i:i+chunksize])
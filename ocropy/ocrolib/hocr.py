@@ -31,3 +31,93 @@ def header():
 def footer():
     return footer_template
 
+
+### Writing pages and lines.
+
+import re
+from numpy import clip
+import common
+
+def escape(text):
+    """Escape text for inclusion in the hOCR output."""
+    text = re.sub(r'\&','\&amp;',text)
+    text = re.sub(r'\<','\&lt;',text)
+    return text
+
+def page_lines(pseg):
+    """Given a page segmentation, return a list of (id,bbox) pairs
+    for the text lines in reading order, where bbox is in math
+    coordinates (y0,x0,y1,x1)."""
+    regions = common.RegionExtractor()
+    regions.setPageLines(pseg)
+    return [(regions.id(i),regions.bboxMath(i)) for i in range(1,regions.length())]
+
+class HocrWriter:
+    """Writes pages and text lines in hOCR format to a stream, keeping
+    track of the layout needed for inserting paragraph breaks."""
+    def __init__(self,stream,median_xheight=None,breaks=0,nopars=0):
+        self.stream = stream
+        self.median_xheight = median_xheight
+        self.breaks = breaks
+        self.nopars = nopars
+        self.last_coords = None
+    def write(self,*args):
+        self.stream.write("".join(args))
+    def header(self):
+        self.write(header(),"\n")
+    def footer(self):
+        self.write(footer(),"\n")
+    def begin_page(self,name):
+        self.write("<div class='ocr_page' title='file %s'>\n"%name)
+    def end_page(self):
+        self.write("</div>\n")
+    def paragraph(self,bbox):
+        """Insert a paragraph break if the line with the given bounding
+        box doesn't continue the preceding one."""
+        y0,x0,y1,x1 = bbox
+        median_xheight = self.median_xheight
+        if self.last_coords is not None:
+            lx0,ly0 = self.last_coords
+            dx,dy = x0-lx0,y1-ly0
+            par = 0
+            if dy>0: 
+                par = 0 # column break... moving upwards
+            else:
+                if median_xheight is not None:
+                    if abs(dy)>5*median_xheight: par = 1 # whitespace separator
+                    if dx>2*median_xheight: par = 1 # indented paragraph
+                    if abs(dx)>10*median_xheight: par = 1 # something else
+            if par and not self.nopars: self.write("<p />\n")
+        self.last_coords = (x0,y0)
+    def line(self,bbox,text,xheight=None,baseline=None):
+        """Output a text line with the given bounding box (in math
+        coordinates), optionally with xheight and baseline information."""
+        y0,x0,y1,x1 = bbox
+        text = escape(text)
+
+        # accumulate information for each line here
+
+        style = ""
+        info = ""
+
+        # estimate the font size for this line
+
+        if self.median_xheight is not None and xheight is not None:
+            perc = int(clip(xheight*100.0/self.median_xheight,30,300))
+            perc = 10*((perc+5)//10)
+            if perc!=100:
+                style += "font-size:%d%%;"%perc
+
+        # output geometric information 
+
+        info += "bbox %d %d %d %d"%(x0,y0,x1,y1)
+        if baseline is not None:
+            info += "; baseline "+baseline
+
+        # put it all together into a SPAN
+
+        self.write("<span")
+        if style!="": self.write(" style='"+style+"'")
+        self.write(" class='ocr_line' title='%s'>"%info,text,"</span>")
+        if self.breaks: self.write("<br />\n")
+        else: self.write("\n")
@@ -2,6 +2,7 @@ from pylab import *
 from collections import Counter,defaultdict
 import glob,re,heapq,os,cPickle
 import ngraphs as ng
+import common
 
 class Edge:
     def __init__(self,**kw):
@@ -23,35 +24,31 @@ class Lattice:
         self.states.add(stop)
         self.edges[start].append(Edge(start=start,stop=stop,cost=cost,cls=cls,seg=seg))
     def readLattice(self,fname):
+        """Read a text or binary lattice file."""
         self.states = set()
         self.edges = defaultdict(list)
-        with open(fname) as stream:
-            for line in stream.readlines():
-                f = line.split()
-                if f[0]=="segment":
-                    first,last = [int(x) for x in f[2].split(":")]
-                    # we put the actual OCR segment numbers at 10x the state;
-                    # that gives us intermediate states to insert spaces and extra
-                    # characters
-                    st_start = 2*first
-                    st_extra = 2*last+1
-                    st_next = 2*last+2
-                    ws,nows = [float(x) for x in f[4:6]]
-                    ws = minimum(ws,self.maxws)
-                    nows = minimum(nows,self.maxws)
-                    if self.edges[st_extra]==[]:
-                        # skip or replace
-                        self.addEdge(start=st_start,stop=st_extra,cost=self.mismatch,cls="")
-                        self.addEdge(start=st_start,stop=st_extra,cost=self.mismatch,cls="~")
-                        # insert space / no space
-                        self.addEdge(start=st_extra,stop=st_next,cost=ws,cls=" ")
-                        self.addEdge(start=st_extra,stop=st_next,cost=nows,cls="")
-                        # insert arbitrary (this implies "no space")
-                        self.addEdge(start=st_extra,stop=st_next,cost=self.mismatch,cls="~")
-                elif f[0]=="chr":
-                    cost = minimum(float(f[3])+nows,self.maxcost)
-                    if len(f)<5: f += [""]
-                    self.addEdge(start=st_start,stop=st_extra,cost=cost+nows,cls=f[4],seg=(first,last))
+        for first,last,sp,chars in read_lattice_file(fname):
+            # we put the actual OCR segment numbers at 10x the state;
+            # that gives us intermediate states to insert spaces and extra
+            # characters
+            st_start = 2*first
+            st_extra = 2*last+1
+            st_next = 2*last+2
+            ws,nows = sp[:2]
+            ws = minimum(ws,self.maxws)
+            nows = minimum(nows,self.maxws)
+            if self.edges[st_extra]==[]:
+                # skip or replace
+                self.addEdge(start=st_start,stop=st_extra,cost=self.mismatch,cls="")
+                self.addEdge(start=st_start,stop=st_extra,cost=self.mismatch,cls="~")
+                # insert space / no space
+                self.addEdge(start=st_extra,stop=st_next,cost=ws,cls=" ")
+                self.addEdge(start=st_extra,stop=st_next,cost=nows,cls="")
+                # insert arbitrary (this implies "no space")
+                self.addEdge(start=st_extra,stop=st_next,cost=self.mismatch,cls="~")
+            for cls,cost in chars:
+                cost = minimum(cost+nows,self.maxcost)
+                self.addEdge(start=st_start,stop=st_extra,cost=cost+nows,cls=cls,seg=(first,last))
         return self
     def isAccept(self,i):
         if self.accept is None:
@@ -82,26 +79,74 @@ class Lattice2:
         self.states.add(stop)
         self.edges[start].append(Edge(start=start,stop=stop,cost=cost,cls=cls,seg=seg))
     def readLattice(self,fname):
+        """Read a text or binary lattice file."""
+        if is_binary_lattice(fname):
+            return self.readBinaryLattice(fname)
         self.states = set()
         self.edges = defaultdict(list)
-        with open(fname) as stream:
-            for line in stream.readlines():
-                f = line.split()
-                if f[0]=="segment":
-                    first,last = [int(x) for x in f[2].split(":")]
-                    st_start = first
-                    st_next = last+1
-                    nows,ws = [-log(1e-6+float(x)) for x in f[4:6]]
-                    ws = minimum(ws*self.wsfactor,self.maxws)
-                    nows = minimum(nows*self.wsfactor,self.maxws)
-                    self.addEdge(start=st_start,stop=st_next,cost=self.mismatch,cls="")
-                    self.addEdge(start=st_start,stop=st_next,cost=self.mismatch,cls="~")
-                elif f[0]=="chr":
-                    if len(f)<5: f += [""]
-                    cost = minimum(float(f[3]),self.maxcost)
-                    self.addEdge(start=st_start,stop=st_next,cost=cost+nows,cls=f[4],seg=(first,last))
-                    self.addEdge(start=st_start,stop=st_next,cost=cost+ws,cls=f[4]+" ",seg=(first,last))
+        for first,last,sp,chars in read_lattice_file(fname):
+            self.addSegment(first,last,sp,chars)
         return self
+    def readBinaryLattice(self,fname):
+        """Read a binary lattice file.  This constructs the same edges
+        as `addSegment`, but computes the costs on the whole arrays."""
+        lat = read_binary_lattice(fname)
+        segs,chars = lat.segments,lat.chars
+        sp = array(segs['sp'],'d')
+        nows = minimum(-log(1e-6+sp[:,0])*self.wsfactor,self.maxws)
+        ws = minimum(-log(1e-6+sp[:,1])*self.wsfactor,self.maxws)
+        costs = minimum(array(chars['cost'],'d'),self.maxcost)
+        which = chars['segment']
+        nows_costs = (costs+nows[which]).tolist()
+        ws_costs = (costs+ws[which]).tolist()
+        clss = chars['cls'].tolist()
+        classes = lat.classes
+        spaced = [c+" " for c in classes]
+        bounds = searchsorted(which,arange(len(segs)+1)).tolist()
+        firsts = segs['first'].tolist()
+        lasts = segs['last'].tolist()
+        self.states = set(firsts)|set([l+1 for l in lasts])
+        self.edges = defaultdict(list)
+        for i in range(len(segs)):
+            first,last = firsts[i],lasts[i]
+            start,next = first,last+1
+            seg = (first,last)
+            edges = self.edges[start]
+            edges.append(Edge(start=start,stop=next,cost=self.mismatch,cls="",seg=(0,0)))
+            edges.append(Edge(start=start,stop=next,cost=self.mismatch,cls="~",seg=(0,0)))
+            for j in range(bounds[i],bounds[i+1]):
+                edges.append(Edge(start=start,stop=next,cost=nows_costs[j],cls=classes[clss[j]],seg=seg))
+                edges.append(Edge(start=start,stop=next,cost=ws_costs[j],cls=spaced[clss[j]],seg=seg))
+        return self
+    def setSegments(self,segments):
+        """Construct the lattice directly from a list of segments
+        (as computed by the line recognizer), without going through
+        a lattice file."""
+        self.states = set()
+        self.edges = defaultdict(list)
+        for s in sorted(segments,key=lambda s:(s.first,s.last)):
+            self.addSegment(s.first,s.last,s.sp,s.out)
+        return self
+    def addSegment(self,first,last,sp,out):
+        """Add the edges for a segment with whitespace probabilities
+        `sp` and a list of (cls,cost) classifier outputs.  Returns
+        the no-space and space costs for the segment."""
+        st_start = first
+        st_next = last+1
+        nows,ws = [-log(1e-6+x) for x in sp[:2]]
+        ws = minimum(ws*self.wsfactor,self.maxws)
+        nows = minimum(nows*self.wsfactor,self.maxws)
+        self.addEdge(start=st_start,stop=st_next,cost=self.mismatch,cls="")
+        self.addEdge(start=st_start,stop=st_next,cost=self.mismatch,cls="~")
+        for cls,cost in out:
+            self.addChar(first,last,cls,cost,nows,ws)
+        return nows,ws
+    def addChar(self,first,last,cls,cost,nows,ws):
+        st_start = first
+        st_next = last+1
+        cost = minimum(cost,self.maxcost)
+        self.addEdge(start=st_start,stop=st_next,cost=cost+nows,cls=cls,seg=(first,last))
+        self.addEdge(start=st_start,stop=st_next,cost=cost+ws,cls=cls+" ",seg=(first,last))
     def isAccept(self,i):
         if self.accept is None:
             self.accept = [self.lastState()]
@@ -114,3 +159,115 @@ class Lattice2:
         edges = reduce(lambda x,y:x+y,[[e for e in l] for k,l in self.edges.items()])
         classes = set([e.cls for e in edges])
         return sorted(list(classes))
+
+################################################################
+### Binary lattice files.  These contain the same information as the
+### text lattice files written by `linerec.write_lattice`, but they can
+### be loaded (or memory mapped) directly as arrays, without parsing.
+###
+### The layout is a header, followed by an array of segments,
+### an array of character hypotheses (sorted by segment), and a table
+### of the class strings (offsets into a block of UTF-8 encoded bytes).
+### Each part starts at a multiple of 8 bytes.
+################################################################
+
+lattice_magic = "OCRLAT01"
+
+header_dtype = dtype([('magic','S8'),('nsegments','<i4'),('nchars','<i4'),
+                      ('nclasses','<i4'),('nbytes','<i4')])
+segment_dtype = dtype([('first','<i4'),('last','<i4'),('bbox','<i4',(4,)),('sp','<f4',(2,))])
+char_dtype = dtype([('segment','<i4'),('cls','<i4'),('cost','<f4')])
+
+def is_binary_lattice(fname):
+    """Check whether the file is a binary lattice file."""
+    with common.open_file(fname,"rb") as stream:
+        return stream.read(len(lattice_magic))==lattice_magic
+
+def padded(n):
+    return (n+7)//8*8
+
+def write_binary_lattice(fname,segments):
+    """Write a list of segments (as computed by the line recognizer)
+    as a binary lattice file."""
+    segments = sorted(segments,key=lambda s:(s.first,s.last))
+    classes = {}
+    chars = []
+    for i,s in enumerate(segments):
+        for cls,cost in s.out:
+            if isinstance(cls,unicode): cls = cls.encode("utf-8")
+            chars.append((i,classes.setdefault(cls,len(classes)),cost))
+    table = sorted(classes.keys(),key=lambda c:classes[c])
+    offsets = cumsum([0]+[len(c) for c in table])
+    header = array([(lattice_magic,len(segments),len(chars),len(table),offsets[-1])],header_dtype)
+    segs = zeros(len(segments),segment_dtype)
+    for i,s in enumerate(segments):
+        b = s.bbox
+        segs[i] = (s.first,s.last,(b[0].start,b[0].stop,b[1].start,b[1].stop),tuple(s.sp[:2]))
+    chars = array(chars,char_dtype)
+    with common.open_file(fname,"wb") as stream:
+        for data in [header.tostring(),segs.tostring(),chars.tostring(),
+                     array(offsets,'<i4').tostring(),"".join(table)]:
+            stream.write(data)
+            stream.write("\0"*(padded(len(data))-len(data)))
+
+def read_binary_lattice(fname,mmap=1):
+    """Read a binary lattice file.  Returns a record containing the
+    `segments` and `chars` arrays (see `segment_dtype` and `char_dtype`)
+    and the list of `classes`; the `cls` field of the characters is an
+    index into that list.  With `mmap`, the arrays are memory mapped
+    from the file instead of being read."""
+    where = common.pack.locate(fname)
+    if where is not None:
+        # a lattice in a pack is mapped from the pack itself
+        pfile,offset,n = where
+        if mmap:
+            data = memmap(pfile,dtype='B',mode='r',offset=offset,shape=(n,))
+        else:
+            data = fromstring(common.open_file(fname,"rb").read(),dtype='B')
+    elif mmap:
+        data = memmap(fname,dtype='B',mode='r')
+    else:
+        data = fromfile(fname,dtype='B')
+    header = data[:header_dtype.itemsize].view(header_dtype)[0]
+    assert header['magic']==lattice_magic,"%s: not a binary lattice file"%fname
+    parts = []
+    offset = 0
+    for n,dt in [(1,header_dtype),(header['nsegments'],segment_dtype),
+                 (header['nchars'],char_dtype),(header['nclasses']+1,dtype('<i4')),
+                 (header['nbytes'],dtype('B'))]:
+        parts.append(data[offset:offset+n*dt.itemsize].view(dt))
+        offset += padded(n*dt.itemsize)
+    _,segments,chars,offsets,text = parts
+    text = text.tostring()
+    classes = [text[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+    return common.Record(segments=segments,chars=chars,classes=classes)
+
+def read_lattice_file(fname):
+    """Read a lattice file, either text or binary, and return a list
+    containing, for each segment, the tuple `(first,last,sp,chars)`
+    with `chars` a list of (cls,cost) pairs.  This is used for constructing
+    the search lattices above."""
+    if is_binary_lattice(fname):
+        lat = read_binary_lattice(fname)
+        segs = lat.segments
+        bounds = searchsorted(lat.chars['segment'],arange(len(segs)+1))
+        sps = array(segs['sp'],'d')
+        costs = array(lat.chars['cost'],'d')
+        clss = lat.chars['cls']
+        result = []
+        for i in range(len(segs)):
+            chars = [(lat.classes[clss[j]],costs[j]) for j in range(bounds[i],bounds[i+1])]
+            result.append((int(segs['first'][i]),int(segs['last'][i]),sps[i],chars))
+        return result
+    result = []
+    with common.open_file(fname) as stream:
+        for line in stream.readlines():
+            f = line.split()
+            if f[0]=="segment":
+                first,last = [int(x) for x in f[2].split(":")]
+                sp = [float(x) for x in f[4:6]]
+                result.append((first,last,sp,[]))
+            elif f[0]=="chr":
+                if len(f)<5: f += [""]
+                result[-1][3].append((f[4],float(f[3])))
+    return result
@@ -40,11 +40,11 @@ def extract_chars(segmentation,h=32,w=32,f=0.5,minscale=0.5):
         m = diag([1.0/scale,1.0/scale])
         offset = array([cy,cx])-dot(m,array([h/2,w/2]))
         def transform(image,m=m,offset=offset):
-            return interpolation.affine_transform(1.0*image,m,offset=offset,order=1,output_shape=(h,w))
+            return interpolation.affine_transform(array(image,'f'),m,offset=offset,order=1,output_shape=(h,w))
         def itransform_add(result,image,m=m,cx=cx,cy=cy):
             im = inv(m)
             ioffset = array([h/2,w/2])-dot(im,array([cy,cx]))
-            result += interpolation.affine_transform(1.0*image,im,offset=ioffset,order=1,output_shape=segmentation.shape)
+            result += interpolation.affine_transform(array(image,'f'),im,offset=ioffset,order=1,output_shape=segmentation.shape)
         cimage = transform(sub)
         yield cimage,transform,itransform_add
 
@@ -1,10 +1,12 @@
 import copy as pycopy
+import traceback
 from collections import Counter,namedtuple,defaultdict
 from pylab import *
 from scipy.ndimage import measurements,morphology
 import common as ocrolib
 from ocrolib import showgrid
-import morph,lineseg,lineproc,sl
+import morph,lineseg,lineproc,sl,improc,default,lattice
+from toplevel import *
 
 class Segment:
     def __init__(self,**kw):
@@ -276,8 +278,19 @@ def clean_line_image(image,latin=1):
     return image
 
 def read_lattice(fname):
+    """Read a lattice file (text or binary) into a list of segments."""
+    if lattice.is_binary_lattice(fname):
+        lat = lattice.read_binary_lattice(fname,mmap=0)
+        segments = []
+        for i,s in enumerate(lat.segments):
+            b = s['bbox']
+            bbox = (slice(b[0],b[1]),slice(b[2],b[3]))
+            out = [(lat.classes[c['cls']],float(c['cost'])) for c in lat.chars[lat.chars['segment']==i]]
+            segments.append(Segment(first=int(s['first']),last=int(s['last']),bbox=bbox,
+                                    sp=[float(x) for x in s['sp']],out=out))
+        return segments
     segments = []
-    with open(fname) as stream:
+    with ocrolib.open_file(fname) as stream:
         for line in stream.readlines():
             if line[0]=="#": continue
             f = line.split()
@@ -288,7 +301,8 @@ def read_lattice(fname):
                 sp = [float(x) for x in f[4:6]]
                 segments.append(Segment(first=first,last=last,bbox=bbox,sp=sp,out=[]))
             elif f[0]=="chr":
-                segments[-1].out.append((float(f[2]),f[3]))
+                if len(f)<5: f += [""]
+                segments[-1].out.append((f[4],float(f[3])))
             else:
                 raise Exception("unknown start of line: "+line)
     return segments
@@ -357,3 +371,186 @@ def bestpath(segs,**kw):
     trans = [(i+1,j) for i,j in trans]
     return labels,costs,trans
 
+
+################################################################
+### Line recognition: segmentation, character size normalization,
+### and classification of the segments into a recognition lattice.
+################################################################
+
+class CharResizer:
+    def __init__(self,sizemode,target_xheight,emodel=None,baselinedegree=1):
+        assert isinstance(sizemode,str)
+        self.sizemode = sizemode
+        assert target_xheight>=8 and target_xheight<=200
+        self.target_xheight = target_xheight
+        self.emodel = emodel
+        self.baselinedegree = baselinedegree
+    def load(self,fname):
+        base = ocrolib.allsplitext(fname)[0]
+        lname = base+".bin.png"
+        limage = ocrolib.read_image_gray(lname,dtype='f')
+        return self.set(limage)
+    def set(self,limage):
+        self.limage = limage
+        params = self.emodel.lineParameters(1-limage,order=self.baselinedegree)
+        self.avgbaseline,self.xheight,self.blp,self.xlp = params
+        return self
+    def show(self):
+        imshow(self.limage)
+        xs = arange(self.limage.shape[1])
+        plot(xs,polyval(self.blp,xs))
+        plot(xs,polyval(self.xlp,xs))
+    def baselineAsText(self):
+        h = len(self.limage)
+        params = -array(self.blp)
+        params[-1] += h
+        return " ".join("%.4f"%x for x in params)
+    def resize(self,image,bbox):
+        if self.sizemode=="linerel":
+            x = bbox[1].start
+            baseline = polyval(self.blp,x)
+            xline = polyval(self.xlp,x)
+            if xline>=baseline: 
+                raise ocrolib.RecognitionError("xline>=baseline %d %d"%(xline,baseline))
+            options = dict(bar=(xline,baseline))
+            scale = self.target_xheight*1.0/self.xheight
+            image = improc.line_normalize(array(image,'f'),scale=scale,**options)
+        elif self.sizemode=="perchar":
+            try:
+                image = improc.classifier_normalize(array(image,'f'))
+            except:
+                traceback.print_exc()
+                raise ocrolib.RecognitionError("classifier_normalize failed, skipping")
+        elif self.sizemode=="lineabs":
+            raise Exception("not implemented yet")
+        else:
+            raise Exception("unknown sizemode:"+self.sizemode)
+        return image
+
+def invert_image(image):
+    """Invert the input image."""
+    return amax(image)-image
+
+def loutputs(cmodel,image,floor=1e-6,keep_rejects=0):
+    """Compute the negative log probability (cost) for classifications
+    of the character image."""
+    outputs = cmodel.coutputs(image)
+    outputs = [(cls,-log(max(p,floor))) for cls,p in outputs if "~" not in cls or keep_rejects]
+    if len(outputs)<1: outputs = [("~",30)]
+    return outputs
+
+def loutputs_batch(cmodel,images,floor=1e-6,keep_rejects=0):
+    """Like `loutputs`, but for a list of character images.  If the
+    model has a `coutputs_batch` method, all the images are classified
+    with a single call."""
+    if hasattr(cmodel,"coutputs_batch"):
+        batch = cmodel.coutputs_batch(images)
+    else:
+        batch = [cmodel.coutputs(image) for image in images]
+    result = []
+    for outputs in batch:
+        outputs = [(cls,-log(max(p,floor))) for cls,p in outputs if "~" not in cls or keep_rejects]
+        if len(outputs)<1: outputs = [("~",30)]
+        result.append(outputs)
+    return result
+
+def make_connected(rsegs,insert=[("~",30.0)]):
+    """Given a list of segmentation hypotheses, inserts
+    reject classes for any segments that are not present.
+    This reconnects the graph in case one of the previous
+    steps has rejected some segment entirely."""
+    if len(rsegs)<1: return
+    transitions = [(r.first,r.last) for r in rsegs]
+    lo = amin([r.first for r in rsegs])
+    hi = amax([r.first for r in rsegs])
+    for i in range(lo,hi+1):
+        if (i,i) not in transitions:
+            rsegs.append(Segment(first=i,last=i,img=zeros((1,1)),
+                                 bbox=(slice(0,1),slice(0,1)),
+                                 out=insert,sp=array([1.0,0])))
+    return rsegs
+
+class LineRecognizer:
+    """Recognizes text lines, producing a recognition lattice (a list
+    of segments with classifier outputs and whitespace probabilities).
+    The models are loaded once and kept in memory, so that the same
+    recognizer can be applied to many lines."""
+    def __init__(self,cmodel,wmodel,emodel,segmenter,sizemode=None,
+                 target_xheight=16,borderclean=8,baselinedegree=1):
+        self.cmodel = cmodel
+        self.wmodel = wmodel
+        self.emodel = emodel
+        self.segmenter = segmenter
+        self.sizemode = sizemode or getattr(cmodel,"sizemode","perchar")
+        self.target_xheight = target_xheight
+        self.borderclean = borderclean
+        self.baselinedegree = baselinedegree
+    def recognize(self,image):
+        """Recognize a grayscale line image.  Returns a record containing
+        the cleaned `image`, the raw segmentation `rseg`, the `lattice`,
+        the best path `labels` without language model (None if there is
+        no path), and the line geometry (`resizer`, `xheight`, `baseline`).
+        Raises RecognitionError if the line cannot be recognized."""
+
+        if self.borderclean>0:
+            h,w = image.shape
+            mask = zeros((h,w),'i')
+            d = minimum(self.borderclean,h//2-4)
+            mask[d:-d,d:-d] = 1
+            image = 1.0*invert_image(morph.keep_marked(image<ocrolib.midrange(image),mask))
+
+        try:
+            checktype(image,LINE)
+        except:
+            raise ocrolib.RecognitionError("doesn't satisfy geometric constraints on lines",shape=image.shape)
+
+        # generate character candidates
+
+        rseg = self.segmenter.charseg(image)
+        rseg = morph.renumber_by_xcenter(rseg)
+        rsegs = extract_rsegs(rseg)
+        if len(rsegs)<1:
+            raise ocrolib.RecognitionError("no raw segments")
+
+        # apply the resizer
+
+        resizer = CharResizer(self.sizemode,self.target_xheight,self.emodel,self.baselinedegree).set(image)
+        rsegs = [r.replace(img=resizer.resize(r.img,r.bbox)) for r in rsegs]
+
+        # classify each character
+
+        outputs = loutputs_batch(self.cmodel,[r.img for r in rsegs])
+        recognized = [r.replace(out=out) for r,out in zip(rsegs,outputs)]
+
+        # compute whitespace probabilities
+
+        self.wmodel.setLine(invert_image(image))
+        recognized = [r.replace(sp=self.wmodel.classifySpace(r.bbox[1].stop)) for r in recognized]
+
+        # make sure the resulting graph is connected
+
+        recognized = make_connected(recognized)
+
+        # compute the best path without a language model for debugging
+
+        labels,costs,trans = bestpath(recognized,noreject=0)
+
+        return ocrolib.Record(image=image,rseg=rseg,lattice=recognized,labels=labels,
+                              resizer=resizer,xheight=resizer.xheight,
+                              baseline=resizer.baselineAsText())
+
+def load_linerec(model=None,whitespace=None,lineest=None,segmenter=None,quiet=0,**kw):
+    """Load the character model, whitespace model, and line geometry model
+    (using the default models if none are given) and return a LineRecognizer.
+    Additional keyword arguments are passed to the LineRecognizer."""
+    def load(name):
+        fname = ocrolib.ocropus_find_file(name)
+        if not quiet: print "loading",fname
+        result = ocrolib.load_component(fname)
+        if not quiet: print "got",result
+        return result
+    cmodel = load(model or default.model)
+    wmodel = load(whitespace or default.space)
+    emodel = load(lineest or default.lineest)
+    if segmenter is None: segmenter = lineseg.ComboSegmentLine()
+    return LineRecognizer(cmodel,wmodel,emodel,segmenter,**kw)
@@ -2,6 +2,81 @@ from pylab import *
 from scipy.ndimage import filters,morphology,measurements
 import common,morph
 from toplevel import *
+from native import compile_and_load,CompileError,I,D,A1I,A2I,A2D,A2F,A2U
+
+################################################################
+### Dynamic programming cuts.  The native code versions compute
+### exactly the same results as the Python versions (`dpcuts_py`
+### and `dptrack_py`) and are used if they can be compiled; set
+### `use_native` to 0 to use the Python versions.  Single precision
+### cost images are used as they are (the costs are accumulated in
+### double precision either way), and the cuts are marked in a byte
+### image.
+################################################################
+
+use_native = 1
+
+dp_native_c = r'''
+#include <stdlib.h>
+
+#define DPCUTS(NAME,T) \
+void NAME(int h,int w,T image[h][w],double alpha,int r, \
+          double costs[h][w],int sources[h][w]) { \
+    for(int x=0;x<w;x++) { \
+        costs[0][x] = 0; \
+        sources[0][x] = 0; \
+    } \
+    for(int i=1;i<h;i++) { \
+        for(int x=0;x<w;x++) { \
+            double c = 9999; \
+            int s = 0; \
+            for(int k=-r;k<=r;k++) { \
+                int px = ((x-k)%w+w)%w; \
+                double nc = costs[i-1][px]+image[i][x]+alpha*abs(k); \
+                if(nc<c) { \
+                    c = nc; \
+                    s = -k; \
+                } \
+            } \
+            costs[i][x] = c; \
+            sources[i][x] = s; \
+        } \
+    } \
+}
+
+DPCUTS(dpcuts,double)
+DPCUTS(dpcuts_f,float)
+
+void dptrack(int h,int w,int sources[h][w],int n,int starts[n],unsigned char result[h][w]) {
+    for(int l=0;l<n;l++) {
+        int x0 = starts[l];
+        int x = starts[l];
+        for(int y=h-1;y>=0;y--) {
+            if(x<0) x = 0;
+            if(x>w-1) x = w-1;
+            int lo = x0<x?x0:x, hi = x0<x?x:x0;
+            for(int j=lo;j<=hi;j++) result[y][j] = 1;
+            x0 = x;
+            if(y>0) x += sources[y-1][x];
+        }
+    }
+}
+'''
+
+dp_native = None
+
+def dp_native_load():
+    global dp_native,use_native
+    if dp_native is not None: return
+    try:
+        dp_native = compile_and_load(dp_native_c)
+    except CompileError:
+        print "WARNING: cannot compile native dpcuts; using the Python version"
+        use_native = 0
+        return
+    dp_native.dpcuts.argtypes = [I,I,A2D,D,I,A2D,A2I]
+    dp_native.dpcuts_f.argtypes = [I,I,A2F,D,I,A2D,A2I]
+    dp_native.dptrack.argtypes = [I,I,A2I,I,A1I,A2U]
 
 @checks(AFLOAT2,alpha=RANGE(0.0,20.0),r=RANGE(0,20))
 def dpcuts(image,alpha=0.5,r=2):
@@ -9,7 +84,23 @@ def dpcuts(image,alpha=0.5,r=2):
     The image contains the costs themselves, `alpha` is the
     cost of taking a diagonal step, and `r` is the range
     of diagonal steps to be considered (determining the
-    maximum slope of a cut."""
+    maximum slope of a cut.  Returns the cost and the step
+    taken for each pixel."""
+    if use_native: dp_native_load()
+    if not use_native: return dpcuts_py(image,alpha=alpha,r=r)
+    if image.dtype==dtype('f'):
+        image = ascontiguousarray(image,'f')
+        native = dp_native.dpcuts_f
+    else:
+        image = ascontiguousarray(image,'d')
+        native = dp_native.dpcuts
+    h,w = image.shape
+    costs = zeros(image.shape,'d')
+    sources = zeros(image.shape,'i')
+    if h>0 and w>0: native(h,w,image,alpha,r,costs,sources)
+    return costs,sources
+
+def dpcuts_py(image,alpha=0.5,r=2):
     costs = 9999*ones(image.shape)
     costs[0,:] = 0
     sources = zeros(image.shape,'i')
@@ -32,7 +123,18 @@ def dptrack(l,s):
     and output an image containing the cuts. The output
     image is guaranteed to be partitioned into separate
     regions by the cuts (so that it can be labeled)."""
-    result = zeros(s.shape)
+    if use_native: dp_native_load()
+    if not use_native: return dptrack_py(l,s)
+    s = array(s,'i',order="C")
+    starts = array(l,'i').ravel()
+    h,w = s.shape
+    assert (starts>=0).all() and (starts<w).all(),"cut start out of range"
+    result = zeros(s.shape,'B')
+    if h>0 and w>0: dp_native.dptrack(h,w,s,len(starts),starts,result)
+    return result
+
+def dptrack_py(l,s):
+    result = zeros(s.shape,'B')
     for i in l:
         x0 = i
         x = i
@@ -228,14 +330,85 @@ def image2contours(image,inside=0):
     del storage
     return seq2list(seq)
 
-from scipy.spatial import distance
-from scipy import linalg
+from scipy.spatial import distance,cKDTree
 
 def image_draw_line(image,y0,x0,y1,x1):
     d = ((y0-y1)**2+(x0-x1)**2)**.5
     for l in linspace(0.0,1.0,int(2*d+1)):
         image[int(l*y0+(1-l)*y1),int(l*x0+(1-l)*x1)] = 1
 
+def contour_minima(cs,mask,maxdist=15,mincdist=20,sigma=1.0,tile=64):
+    """Given the points `cs` of a closed contour, consider the matrix of
+    all pairwise distances between the points (smoothed by `sigma`) and find
+    the true local minima (according to the grayscale erosion with `mask`)
+    for pairs of points that are closer than `maxdist` but separated by at least
+    `mincdist` along the contour.  Returns the list of the centers of mass
+    of the (4-connected) groups of minima.
+
+    For long contours, the complete n x n matrix is not computed.  The points can move by only
+    a bounded amount along the contour, so smoothed distances below `maxdist`
+    can only occur near pairs of points whose actual distance is below
+    `maxdist` plus a margin; these pairs are found with a k-d tree, and the
+    matrix is only computed for the `tile` x `tile` blocks containing
+    them (plus enough border for the smoothing and the erosion to give
+    the same values as for the complete matrix)."""
+    n = len(cs)
+    if n<1: return []
+    gr = int(4.0*sigma+0.5) if sigma>1e-15 else 0
+    halo = gr+amax(mask.shape)
+    step = amax(sqrt(sum((cs-roll(cs,1,axis=0))**2,axis=1)))
+    margin = 2*gr*step+1.0
+
+    # find the blocks that may contain minima; the diagonal blocks
+    # are always included since the contour distance there is small
+    if n<=8*tile:
+        # short contours are handled as a single block
+        tile = n
+        blocks = set([(0,0)])
+    else:
+        pairs = array(list(cKDTree(cs).query_pairs(maxdist+margin)),'i').reshape(-1,2)
+        blocks = set(zip(pairs[:,0]//tile,pairs[:,1]//tile))
+        blocks |= set(zip(pairs[:,1]//tile,pairs[:,0]//tile))
+        blocks |= set([(b,b) for b in range((n+tile-1)//tile)])
+
+    # the path length along the contour between two points
+    l = abs(arange(n)-n/2.0)
+    l = l[0]-l
+
+    points = []
+    for bi,bj in sorted(blocks):
+        i0,i1 = bi*tile,min(n,(bi+1)*tile)
+        j0,j1 = bj*tile,min(n,(bj+1)*tile)
+        rows = arange(i0-halo,i1+halo)%n
+        cols = arange(j0-halo,j1+halo)%n
+        ds = distance.cdist(cs[rows],cs[cols])
+        ds = filters.gaussian_filter(ds,(sigma,sigma),mode='wrap')
+        ge = morphology.grey_erosion(ds,structure=mask,mode='wrap')
+        ds = ds[halo:halo+i1-i0,halo:halo+j1-j0]
+        ge = ge[halo:halo+i1-i0,halo:halo+j1-j0]
+        ii,jj = mgrid[i0:i1,j0:j1]
+        cds = l[(ii-jj)%n]
+        locs = (ds<=ge)*(ds<maxdist)*(cds>=mincdist)
+        points += zip(ii[locs],jj[locs])
+
+    # group the minima into 4-connected components, numbered in
+    # raster order (like `measurements.label`)
+    points = sorted(points)
+    unseen = set(points)
+    cms = []
+    for p in points:
+        if p not in unseen: continue
+        unseen.remove(p)
+        group = [p]
+        for i,j in group:
+            for q in [(i-1,j),(i+1,j),(i,j-1),(i,j+1)]:
+                if q in unseen:
+                    unseen.remove(q)
+                    group.append(q)
+        group = array(group)
+        cms.append((sum(group[:,0])*1.0/len(group),sum(group[:,1])*1.0/len(group)))
+    return cms
+
 def contourcuts(image,maxdist=15,minrange=10,mincdist=20,sigma=1.0,debug=0,r=8,s=0.5):
     if debug:
         figure(1); clf(); imshow(image)
@@ -251,32 +424,9 @@ def contourcuts(image,maxdist=15,minrange=10,mincdist=20,sigma=1.0,debug=0,r=8,s
 
     # now handle each (external) contour individually
     for k,cs in enumerate(contours):
-        # compute a matrix of all the pairwise distances of pixels
-        # around the contour, then smooth it a little
-        ds = distance.cdist(cs,cs)
-        ds = filters.gaussian_filter(ds,(sigma,sigma),mode='wrap')
-        # compute a circulant matrix telling us the pathlength
-        # between any two pixels on the contour
-        n = len(cs)
-        l = abs(arange(n)-n/2.0)
-        l = l[0]-l
-        cds = linalg.circulant(l)
-        
-        # find true local minima (exclude ridges) by using the
-        # structuring element above
-        ge = morphology.grey_erosion(ds,structure=mask,mode='wrap')
-        locs = (ds<=ge)
-
-        # restrict it to pairs of points that are closer than maxdist
-        locs *= (ds<maxdist)
-
-        # restrict it to paris of points that are separated by
-        # at least mincdist on the contour
-        locs *= (cds>=mincdist)
-
-        # label the remaining minima and locate them
-        locs,n = measurements.label(locs)
-        cms = measurements.center_of_mass(locs,locs,range(1,n+1))
+        # find the local minima of the (smoothed) pairwise
+        # distances of pixels around the contour
+        cms = contour_minima(cs,mask,maxdist=maxdist,mincdist=mincdist,sigma=sigma)
 
         # keep only on of each pair (in canonical ordering)
         cms = [(int(i+0.5),int(j+0.5)) for i,j in cms if i<j]
@@ -294,8 +444,8 @@ def contourcuts(image,maxdist=15,minrange=10,mincdist=20,sigma=1.0,debug=0,r=8,s
                 figure(1); plot([x0,x1],[y0,y1],color)
 
         if debug:
-            figure(2); clf(); ion(); imshow(locs!=0)
-            figure(3); clf(); imshow(minimum(ds,maxdist*1.5),interpolation='nearest')
+            figure(2); clf(); ion()
+            if len(cms)>0: plot([j for i,j in cms],[i for i,j in cms],'r.')
             ginput(1,0.1)
             print "hit ENTER"; raw_input()
     # now construct a cut image
@@ -372,6 +522,11 @@ if __name__=="__main__":
     test.add_argument("--r",type=int,default=1,help="range for diagonal steps (%(default)d)")
     test.add_argument("--threshold",type=float,default=0.5)
     test.add_argument("files",nargs="+",default=[])
+    benchmark = subparsers.add_parser("benchmark",
+        help="compare the native and Python dynamic programming cuts (speed and results)")
+    benchmark.add_argument("--r",type=int,default=1,help="range for diagonal steps (%(default)d)")
+    benchmark.add_argument("-n","--repeat",type=int,default=3,help="number of repetitions (%(default)d)")
+    benchmark.add_argument("files",nargs="+",default=[])
     # test2 = subparsers.add_parser("test2")
     args = parser.parse_args()
     if args.subcommand=="test":
@@ -392,5 +547,28 @@ if __name__=="__main__":
             raw_input()
         else:
             parser.print_help()
+    if args.subcommand=="benchmark":
+        import time
+        segmenter = DPSegmentLine(r=args.r)
+        images = [ocrolib.read_image_gray(fname) for fname in args.files]
+        inverted = [amax(image)-image for image in images]
+        times = {}
+        results = {}
+        for native in [0,1]:
+            use_native = native
+            start = time.time()
+            for i in range(args.repeat):
+                for image in inverted: dplineseg2(image,r=args.r)
+            dptime = (time.time()-start)/args.repeat
+            start = time.time()
+            for i in range(args.repeat):
+                results[native] = [segmenter.charseg(image) for image in images]
+            times[native] = (dptime,(time.time()-start)/args.repeat)
+        for fname,a,b in zip(args.files,results[0],results[1]):
+            if (a!=b).any(): print "DIFFERENT",fname
+        print "lines",len(images)
+        for i,what in enumerate(["dplineseg2","charseg"]):
+            tp,tn = times[0][i],times[1][i]
+            print "%-12s python %.3fs native %.3fs speedup %.1f"%(what,tp,tn,tp/max(tn,1e-6))
     sys.exit(0)
 
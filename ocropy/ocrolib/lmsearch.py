@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+################################################################
+### Beam search through recognition lattices under an n-graph
+### language model.  This is the computation behind ocropus-ngraphs,
+### factored out so that it can be used in-process (e.g., by
+### ocropus-recognize-book).
+################################################################
+
+# FIXME handle cost accounting for multi-character classes correctly
+# FIXME different end-of-line handling
+# FIXME right now, it can't really "look back" to add rejected characters; they usually fall out of the beam too early
+
+from pylab import *
+from collections import defaultdict
+import codecs,heapq
+import common
+
+class Path(object):
+    """A search path.  Paths created during the search only store their
+    last step and a back-pointer to the path they extend (plus a short
+    `tail` of the string for the language model context); the full
+    `path` string, `sequence` and `labels` are reconstructed on demand.
+    Paths constructed explicitly store all of these directly."""
+    __slots__ = ["cost","state","prev","edge","label","length","tail","_path","_sequence","_labels"]
+    def __init__(self,cost=0.0,state=-1,path="",sequence=[],labels=[]):
+        self.cost = cost # total cost accumulated along this path
+        self.state = state # state in the lattice
+        self.prev = None # the path this path extends
+        self.edge = None # the last edge (None for characters outside the lattice)
+        self.label = None # the last label
+        self.length = len(path) # length of the path string
+        self.tail = None # the last few characters of the path string
+        self._path = path # current sequence of characters
+        self._sequence = list(sequence) # current sequence of states
+        self._labels = list(labels) # current sequence of labels (list corresponding to sequence)
+    def extend(self,cost,state,edge,label,width):
+        """Return a new path extending this one by one step."""
+        p = Path.__new__(Path)
+        p.cost = cost
+        p.state = state
+        p.prev = self
+        p.edge = edge
+        p.label = label
+        p.length = self.length+len(label)
+        p.tail = (self.tail+label)[-width:]
+        p._path = None
+        return p
+    def steps(self):
+        """Return the root of the chain of back-pointers and the
+        paths extending it, in order."""
+        result = []
+        p = self
+        while p.prev is not None:
+            result.append(p)
+            p = p.prev
+        return p,result[::-1]
+    @property
+    def path(self):
+        if self._path is None:
+            labels = []
+            p = self
+            while p._path is None:
+                labels.append(p.label)
+                p = p.prev
+            self._path = p._path+"".join(labels[::-1])
+        return self._path
+    @property
+    def sequence(self):
+        root,steps = self.steps()
+        return root._sequence+[p.edge for p in steps]
+    @property
+    def labels(self):
+        root,steps = self.steps()
+        return root._labels+[p.label for p in steps]
+    def __repr__(self):
+        return "<Path %.2f %d '%s'>"%(self.cost,self.state,self.path)
+    def __str__(self):
+        return self.__repr__()
+    def __lt__(self,other):
+        # the path strings are only needed to break ties
+        if self.cost!=other.cost: return self.cost<other.cost
+        if self.state!=other.state: return self.state<other.state
+        return self.path<other.path
+    def __cmp__(self,other):
+        return cmp((self.cost,self.state,self.path),(other.cost,other.state,other.path))
+
+def read_rewrites(fname,rcost=1.0):
+    """Read a file of rewrite rules (lines of the form
+    `add<TAB>from<TAB>to<TAB>cost`) into a dictionary mapping
+    suffixes to lists of (replacement,cost) pairs."""
+    rewrites = defaultdict(list)
+    with codecs.open(common.findfile(fname)) as stream:
+        for line in stream.readlines():
+            line = line[:-1]
+            f = line.split("\t")
+            assert f[0]=="add"
+            rewrites[f[1]].append((f[2],rcost+float(f[3])))
+    return rewrites
+
+def rewrite_path(path,rewrites):
+    result = [path]
+    for i in range(1,min(4,len(path.path))):
+        l = rewrites.get(path.path[-i:],[])
+        for o,c in l:
+            npath = path.path[:-i]+o
+            nlabels = path.labels[:-1]+["_"]
+            p = Path(cost=path.cost+c,state=path.state,path=npath,sequence=path.sequence,labels=nlabels)
+            result.append(p)
+    return result
+
+class Contexts:
+    """Caches the language model posteriors and best guesses for the
+    contexts encountered during the search.  Contexts are represented by
+    the last `width` characters of the path, which determine the language
+    model context as long as they don't normalize (`ngraphs.lineproc`) to
+    fewer than N characters; this assumes that the normalization only
+    depends on a bounded context, which is true for the standard
+    replacements.  Otherwise, the complete path is used.  The same
+    instance can be used for searching many lattices."""
+    def __init__(self,ngraphs,extra=4,maxsize=1000000):
+        self.ngraphs = ngraphs
+        self.N = ngraphs.N
+        self.width = ngraphs.N+extra
+        self.maxsize = maxsize
+        self.missing = None
+        self.clear()
+    def clear(self):
+        self.complete = {}
+        self.lposteriors = {}
+        self.guesses = {}
+        self.classes = {}
+    def setMissing(self,missing):
+        if missing!=self.missing: self.clear()
+        if len(self.lposteriors)+len(self.guesses)>self.maxsize: self.clear()
+        self.missing = missing
+        self.ngraphs.missing = {"~":missing}
+    def key(self,path,extra=""):
+        """Return a string that has the same language model context as
+        the string of `path` followed by `extra`."""
+        if path.tail is None: path.tail = path.path[-self.width:]
+        s = path.tail+extra
+        ok = self.complete.get(s)
+        if ok is None:
+            ok = (len(self.ngraphs.lineproc(s))>=self.N)
+            self.complete[s] = ok
+        if ok or len(path.tail)==path.length: return s
+        return path.path+extra
+    def getLogPosteriors(self,s):
+        result = self.lposteriors.get(s)
+        if result is None:
+            result = self.ngraphs.getLogPosteriors(s)
+            self.lposteriors[s] = result
+        return result
+    def getBestGuesses(self,s,nother):
+        result = self.guesses.get((s,nother))
+        if result is None:
+            result = self.ngraphs.getBestGuesses(s,nother=nother)
+            self.guesses[(s,nother)] = result
+        return result
+    def lineproc(self,cls):
+        result = self.classes.get(cls)
+        if result is None:
+            result = self.ngraphs.lineproc(cls)
+            self.classes[cls] = result
+        return result
+
+class Expander:
+    """Expands search paths through a lattice; see `expand` for the
+    parameters.  This keeps the pruned and sorted edges for each state
+    of the lattice."""
+    def __init__(self,lattice,ngraphs,
+                 cweight=1.0,lweight=1.0,
+                 missing=15.0,
+                 thresh=1.0,
+                 nbest=5,
+                 other=15.0,nother=1,lother=1.0,
+                 noreject=1,
+                 contexts=None):
+        self.lattice = lattice
+        self.ngraphs = ngraphs
+        self.cweight = cweight
+        self.lweight = lweight
+        self.floor = missing
+        self.thresh = thresh
+        self.nbest = nbest
+        self.other = other
+        self.nother = nother
+        self.noreject = noreject
+        if contexts is None: contexts = Contexts(ngraphs)
+        self.contexts = contexts
+        contexts.setMissing(missing)
+        self.edges = {}
+    def getEdges(self,state):
+        """Return the best `nbest` edges leaving the state (without
+        rejects), with their normalized classes and language model
+        weights, and the transitions for characters outside the lattice."""
+        result = self.edges.get(state)
+        if result is not None: return result
+        edges = self.lattice.edges[state]
+        edges = sorted(edges,key=lambda e:e.cost)
+        edges = edges[:self.nbest]
+        selected = []
+        transitions = set()
+        for e in edges:
+            if self.noreject and "~" in e.cls: continue
+            assert e.start==state
+            assert e.stop>state,("oops: %s %s %s %s"%(e.start,e.stop,e.cls,e.cost))
+            if e.cls!="" and e.cls!=" ":
+                transitions.add((e.start,e.stop))
+            # we apply the same string transformation to the predicted classes
+            # as to the language model
+            cls = self.contexts.lineproc(e.cls)
+            l = 0.0 if e.cost<self.thresh and e.cls!=" " else self.lweight
+            selected.append((e,cls,l))
+        result = (selected,list(transitions))
+        self.edges[state] = result
+        return result
+    def expand(self,path,rank=-1,verbose=0):
+        contexts = self.contexts
+        width = contexts.width
+        cweight = self.cweight
+        floor = self.floor
+        key = contexts.key(path)
+        lposteriors = contexts.getLogPosteriors(key)
+        edges,transitions = self.getEdges(path.state)
+        result = []
+
+        # add all the transitions for which we have edges
+        for e,cls,l in edges:
+            # add transitions for single and multi-character classes
+            # returned by the classifier
+            if len(cls)==0:
+                ncost = path.cost + cweight*e.cost
+                # FIXME we really need to add a penalty for not having whitespace here
+                if verbose:
+                    print "EMPTY","ncost",ncost
+            elif len(cls)==1:
+                lcost = lposteriors.get(cls,floor)
+                ncost = path.cost + cweight*e.cost + l*lcost
+                if verbose:
+                    prefix = self.ngraphs.lineproc(path.path)[-5:]
+                    print "prefix",repr(prefix),"cls",repr(cls),"ecost",cweight*e.cost,"lcost",lcost,"ncost",ncost,"seg",e.seg
+            else:
+                ncost = path.cost + cweight*e.cost
+                for c in cls:
+                    lcost = contexts.getLogPosteriors(contexts.key(path,c)).get(c,floor)
+                    ncost += l*lcost
+                if verbose:
+                    print "MULTI","prefix",repr((path.path+c)[-10:]),"cls",repr(c),repr(cls),
+                    print "ecost",cweight*e.cost,"lcost",lcost,"ncost",ncost
+            result.append(path.extend(ncost,e.stop,e,e.cls,width))
+
+        # now add `nother` extra transitions for characters predicted by the language
+        # model but not returned by the classifier; this adds the `other` cost
+        # to the cost from the language model itself
+
+        best = contexts.getBestGuesses(key,self.nother)
+        for start,stop in transitions:
+            for (lcls,lcost) in best:
+                ncost = path.cost + self.other + lcost
+                if verbose:
+                    print "OTHER","path",(path.path+lcls)[-10:],"lcost",lcost
+                result.append(path.extend(ncost,stop,None,lcls,width))
+
+        return result
+
+def expand(path,lattice,ngraphs,
+           rank=-1,
+           verbose=0,
+           **kw):
+    """Expand a search path.  Arguments are:
+
+    - `path` the path to be expanded
+    - `lattice` the recognition lattice
+    - `ngraphs` the ngraph model
+    - `rank` the rank of the current path (for debugging)
+    - `verbose` display extra information for debugging
+    - `cweight` the weight of the classifier costs
+    - `lweight` the weight of the language model costs
+    - `missing` the cost of missing characters in the posterior
+    - `thresh` the treshold below which the language model cost is ignored entirely
+    - `nbest` the number of edges considered for each state
+    - `other` the cost for inserting non-lattice characters into the search
+    - `nother` the number of non-lattice characters added (top # of characters from posterior)
+    - `lother` the language model weight for non-lattice characters
+    - `noreject` eliminate reject classes from matching
+    - `contexts` a `Contexts` instance for caching language model lookups
+    """
+    return Expander(lattice,ngraphs,**kw).expand(path,rank=rank,verbose=verbose)
+
+def eliminate_common_suffixes_and_sort(paths,n):
+    # sort by cost
+    paths = sorted(paths)
+    # keep track of the best
+    result = {}
+    for p in paths:
+        suffix = p.path[-n:]
+        if suffix in result: continue
+        result[suffix] = p
+    return sorted(result.values())
+
+def add_path(table,p,n,width):
+    """Add a path to a table of paths mapping suffixes of length `n`
+    to the best path with that suffix; of paths that compare equal,
+    the first one is kept."""
+    if p.tail is None: p.tail = p.path[-width:]
+    suffix = p.tail[-n:]
+    old = table.get(suffix)
+    if old is None or p<old: table[suffix] = p
+
+def best_paths(paths,n):
+    """Return the `n` best of the given paths, best first.  This
+    uses a heap rather than sorting all the paths."""
+    heap = list(paths)
+    heapq.heapify(heap)
+    return [heapq.heappop(heap) for i in range(min(n,len(heap)))]
+
+def search(lattice,ngraphs,accept=None,verbose=0,beam=100,rewrites=None,
+           debugpaths=0,debugstates=[],debugmaxrank=4,contexts=None,**kw):
+    """Search through the lattice for the best paths under the
+    ngraph model.  Returns the list of paths reaching the final
+    state, best first.  Additional keyword arguments are passed
+    on to `expand`.  When searching many lattices, pass the same
+    `contexts` (see `Contexts`) to each search."""
+    N = ngraphs.N
+    expander = Expander(lattice,ngraphs,contexts=contexts,**kw)
+    width = expander.contexts.width
+    initial = Path(cost=0.0,state=lattice.startState(),path="_"*N)
+    nstates = lattice.lastState()+1
+    # for each state, the best path for each suffix reaching it
+    table = [{} for i in range(nstates)]
+    add_path(table[initial.state],initial,N,width)
+
+    for i in range(nstates):
+        if lattice.isAccept(i): break
+        if len(table[i])==0: continue
+
+        # now apply the rewrites
+        if rewrites is not None:
+            npaths = {}
+            for p in sorted(table[i].values()):
+                for q in rewrite_path(p,rewrites):
+                    add_path(npaths,q,N,width)
+            table[i] = npaths
+
+        paths = best_paths(table[i].values(),beam)
+        if debugpaths: print i,paths[0]
+        if i in debugstates: print "=== state",i
+        for rank,s in enumerate(paths):
+            debugexpand = (rank<=debugmaxrank and i in debugstates)
+            if debugexpand: print "\n--- EXPANDING",rank,s
+            for e in expander.expand(s,rank=rank,verbose=debugexpand):
+                add_path(table[e.state],e,N,width)
+
+    result = sorted(table[i].values())
+    return result
+
+
+def compute_cseg(path,rseg):
+    """Given the best path and the raw segmentation, compute the
+    character segmentation and the corresponding list of characters."""
+    nmax = 10000
+    assert amax(rseg)<nmax,"rseg contains too many characters, or there is a bug somewhere"
+    mapping = zeros(nmax,'i')
+    gt = []
+    for i,e in enumerate(path.sequence):
+        c = path.labels[i]
+        if c=="": continue
+        # some of the labels end in " "; we need to separate
+        # those spaces from the characters preceding them
+        # (otherwise they'd be treated as ligatures)
+        sp = ""
+        if c[-1]==" ":
+            c = c[:-1]
+            sp = " "
+        if e is None: continue
+        if c!="":
+            gt.append(c)
+            for s in range(e.seg[0],e.seg[1]+1):
+                mapping[s] = len(gt)
+        if sp!="":
+            gt.append(sp)
+    return mapping[rseg],gt
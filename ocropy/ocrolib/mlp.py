@@ -475,6 +475,17 @@ class MLP:
         else:
             raise Exception("data has unknown type")
         return result
+    def coutputs(self,v,geometry=None):
+        """Compute the ranked list of (class,probability) pairs for a single
+        input vector; classes are the output unit numbers."""
+        return self.coutputs_batch([v])[0]
+    def coutputs_batch(self,vs,geometries=None):
+        """Compute the ranked (class,probability) lists for a list of input
+        vectors with a single call to the native forward propagation."""
+        if len(vs)==0: return []
+        data = array([asarray(v,'f').ravel() for v in vs],'f')
+        result = self.outputs(data)
+        return [sorted(enumerate(pred),key=lambda x:-x[1]) for pred in result]
 
 def log_uniform(lo,hi):
     return exp(pyrandom.uniform(log(lo),log(hi)))
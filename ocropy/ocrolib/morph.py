@@ -73,14 +73,14 @@ def rb_dilation(image,size,origin=0):
     """Binary dilation using linear filters."""
     output = zeros(image.shape,'f')
     filters.uniform_filter(image,size,output=output,origin=origin,mode='constant',cval=0)
-    return array(output>0,'i')
+    return array(output>0,'B')
 
 @checks(ABINARY2,uintpair)
 def rb_erosion(image,size,origin=0):
     """Binary erosion using linear filters."""
     output = zeros(image.shape,'f')
     filters.uniform_filter(image,size,output=output,origin=origin,mode='constant',cval=1)
-    return array(output==1,'i')
+    return array(output==1,'B')
 
 @checks(ABINARY2,uintpair)
 def rb_opening(image,size,origin=0):
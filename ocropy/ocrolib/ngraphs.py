@@ -3,8 +3,10 @@
 
 from pylab import *
 from collections import Counter,defaultdict
-import glob,re,heapq,os,cPickle
-import codecs
+import glob,re,heapq,os,cPickle,multiprocessing
+import codecs,sre_parse
+from sre_constants import LITERAL,NOT_LITERAL,IN,ANY
+import common
 
 def method(cls):
     """Adds the function as a method to the given class."""
@@ -58,23 +60,110 @@ def safe_readlines(stream,nonl=0):
             if not once: print lineno,":",e
             once = 1
             return
-        if line is None: return
+        if line is None or line=="": return
         if nonl and line[-1]=="\n": line = line[:-1]
         yield line
 
+def is_charwise(regex):
+    """Check whether a regular expression always matches exactly
+    one character, so that replacing its matches can be done character
+    by character."""
+    try:
+        parsed = list(sre_parse.parse(regex,re.U))
+    except:
+        return 0
+    return len(parsed)==1 and parsed[0][0] in [LITERAL,NOT_LITERAL,IN,ANY]
+
+class CharTable(dict):
+    """A translation table for a list of character-by-character
+    replacements; it maps single characters to the result of applying
+    all the replacements to them.  Entries are computed the first time
+    a character is looked up."""
+    def __init__(self,rules):
+        self.rules = rules
+    def __missing__(self,c):
+        s = c
+        for regex,subst in self.rules:
+            s = regex.sub(subst,s)
+        self[c] = s
+        return s
+    def lookup(self,match):
+        return self[match.group()]
+
+class Normalizer:
+    """Applies a list of regular expression replacements to strings, the
+    same as calling `re.sub` for each of them in turn.  Runs of replacements
+    that only ever match single characters are combined into a single pass
+    with a translation table, the remaining ones are precompiled.  Results
+    for short strings (edge classes and the tails of search paths) are cached."""
+    def __init__(self,replacements,maxlen=16,maxcache=100000):
+        self.replacements = replacements
+        self.maxlen = maxlen
+        self.maxcache = maxcache
+        self.stages = []
+        rules = []
+        for regex,subst in replacements+[(None,None)]:
+            if regex is not None and is_charwise(regex):
+                rules.append((regex,subst))
+                continue
+            if len(rules)>0:
+                # any character not matched by one of the rules is left
+                # alone by all of them, so we only need to look up the matches
+                combined = re.compile("|".join(["(?:%s)"%r for r,_ in rules]),re.U)
+                compiled = [(re.compile(r,re.U),t) for r,t in rules]
+                tables = {str:CharTable(compiled),unicode:CharTable(compiled)}
+                self.stages.append((combined,None,tables))
+                rules = []
+            if regex is not None:
+                self.stages.append((re.compile(regex,re.U),subst,None))
+        self.cache = {str:{},unicode:{}}
+    def normalize(self,s):
+        for regex,subst,tables in self.stages:
+            if tables is not None:
+                subst = tables[unicode if isinstance(s,unicode) else str].lookup
+            s = regex.sub(subst,s)
+        return s
+    def __call__(self,s):
+        if len(s)>self.maxlen: return self.normalize(s)
+        cache = self.cache.get(type(s))
+        if cache is None: return self.normalize(s)
+        result = cache.get(s)
+        if result is None:
+            if len(cache)>=self.maxcache: cache.clear()
+            result = self.normalize(s)
+            cache[s] = result
+        return result
+
 class NGraphsCounts:
     def __init__(self,N=3,replacements=replacements):
         self.N = N
         self.replacements = replacements
         self.missing = {"~":15.0}
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("normalizer",None)
+        return state
     def lineproc(self,s):
         """Preprocessing for the line (and also lattice output strings).
         This is used to normalize quotes, remove illegal characters,
         and collapse some character classes (e.g., digits) into a single
         representative."""
-        for regex,subst in self.replacements:
-            s = re.sub(regex,subst,s,flags=re.U)
-        return s
+        normalizer = getattr(self,"normalizer",None)
+        if normalizer is None or normalizer.replacements is not self.replacements:
+            normalizer = self.normalizer = Normalizer(self.replacements)
+        return normalizer(s)
+    def context(self,s,extra=4):
+        """Return the normalized context (the last N-1 characters after
+        `lineproc`) for the string `s`.  Only the last few characters of
+        `s` are normalized, unless they normalize to fewer than N characters;
+        this relies on the replacements depending only on a bounded context
+        (true for `replacements` and `replacements2`), and makes the cost
+        independent of the length of `s`."""
+        tail = s[-(self.N+extra):]
+        result = self.lineproc(tail)
+        if len(result)<self.N and len(tail)<len(s):
+            result = self.lineproc(s)
+        return result[-self.N+1:]
     def computeNGraphs(self,fnames,n):
         """Given a set of text file names, compute a counter
         of n-graphs in those files, after performing the regular
@@ -106,6 +195,143 @@ class NGraphsCounts:
                         counter[sub] += 1
         return counter
 
+################################################################
+### Counting n-graphs in large corpora.
+###
+### N-graphs are represented as rows of N code points (uint32) with
+### separate counts.  Each file is counted in batches of lines by a
+### worker process, and the partial counts are merged by sorting
+### the rows and summing the counts of identical rows, so only the
+### distinct n-graphs are kept in memory.
+################################################################
+
+def merge_counts(grams,counts):
+    """Given an array of n-graphs (one per row) and their counts,
+    return the distinct n-graphs in lexicographic order and their
+    total counts."""
+    if len(grams)==0: return grams,counts
+    bits = max(1,int(amax(grams)).bit_length())
+    new = ones(len(grams),bool)
+    if bits*grams.shape[1]<=63:
+        # pack the rows into integers with the same order; sorting
+        # those is much faster than a lexicographic sort
+        keys = zeros(len(grams),'int64')
+        for j in range(grams.shape[1]):
+            keys <<= bits
+            keys |= grams[:,j]
+        order = argsort(keys)
+        keys = keys[order]
+        new[1:] = (keys[1:]!=keys[:-1])
+    else:
+        order = lexsort(grams.T[::-1])
+        new[1:] = (grams[order][1:]!=grams[order][:-1]).any(axis=1)
+    grams = grams[order]
+    counts = counts[order]
+    starts = flatnonzero(new)
+    return grams[starts],add.reduceat(counts,starts)
+
+def line_ngraphs(lines,n):
+    """Return the n-graphs (as rows of code points) in a list of
+    (normalized and padded) unicode lines."""
+    lengths = array([len(line) for line in lines],'i')
+    codes = fromstring(u"".join(lines).encode("utf-32-le"),'<u4')
+    # an n-graph may start at positions 0...len(line)-n-1 of each line
+    valid = zeros(len(codes)+1,'i')
+    ends = add.accumulate(lengths)
+    starts = ends-lengths
+    counted = maximum(lengths-n,0)
+    add.at(valid,starts,1)
+    add.at(valid,starts+counted,-1)
+    valid = flatnonzero(add.accumulate(valid)[:len(codes)])
+    return array([codes[valid+j] for j in range(n)],'uint32').T.reshape(-1,n)
+
+def count_file(job):
+    """Count the n-graphs in a text file, given as a tuple
+    (fname,n,lineskip,linelimit,replacements), after performing the
+    replacements.  A `linelimit` of 0 means no limit.  Returns the distinct
+    n-graphs and their counts."""
+    fname,n,lineskip,linelimit,replacements = job
+    proc = NGraphsCounts(N=n,replacements=replacements)
+    grams = zeros((0,n),'uint32')
+    counts = zeros(0,'int64')
+    batch = []
+    nchars = 0
+    with codecs.open(fname,"r","utf-8") as stream:
+        for lineno,line in enumerate(safe_readlines(stream)):
+            assert type(line)==unicode
+            if lineno<lineskip: continue
+            if linelimit>0 and lineno>=linelimit+lineskip: break
+            line = line[:-1]
+            if len(line)<3: continue
+            line = proc.lineproc(line)
+            line = "_"*(n-1)+line+"_"*(n-1)
+            batch.append(line)
+            nchars += len(line)
+            if nchars>=1000000:
+                new = line_ngraphs(batch,n)
+                grams,counts = merge_counts(concatenate([grams,new]),
+                                            concatenate([counts,ones(len(new),'int64')]))
+                batch = []
+                nchars = 0
+    new = line_ngraphs(batch,n)
+    return merge_counts(concatenate([grams,new]),concatenate([counts,ones(len(new),'int64')]))
+
+def count_ngraphs(fnames,n,replacements=replacements,linelimit=2000,parallel=1,verbose=1):
+    """Count the n-graphs in the given text files, processing files
+    in `parallel` processes.  As for `NGraphsCounts.computeNGraphs`, the
+    list of files may contain entries of the form `lineskip=...` and
+    `linelimit=...` that apply to the files following them.  Returns
+    the distinct n-graphs (as rows of code points) and their counts."""
+    jobs = []
+    lineskip = 0
+    for fname in fnames:
+        if fname.startswith("lineskip="):
+            lineskip = int(fname.split("=")[1])
+            continue
+        if fname.startswith("linelimit="):
+            linelimit = int(fname.split("=")[1])
+            continue
+        jobs.append((fname,n,lineskip,linelimit,replacements))
+    if parallel<2:
+        results = (count_file(job) for job in jobs)
+    else:
+        pool = multiprocessing.Pool(processes=parallel)
+        results = pool.imap_unordered(count_file,jobs)
+    grams = zeros((0,n),'uint32')
+    counts = zeros(0,'int64')
+    partial_grams = []
+    partial_counts = []
+    for i,(g,c) in enumerate(results):
+        if verbose: print i,"of",len(jobs),":",len(g),"distinct %d-graphs"%n
+        partial_grams.append(g)
+        partial_counts.append(c)
+        if sum([len(g) for g in partial_grams])>len(grams)+1000000:
+            grams,counts = merge_counts(concatenate([grams]+partial_grams),concatenate([counts]+partial_counts))
+            partial_grams = []
+            partial_counts = []
+    if parallel>=2: pool.close()
+    return merge_counts(concatenate([grams]+partial_grams),concatenate([counts]+partial_counts))
+
+def count_posteriors(grams,counts):
+    """Given the distinct n-graphs in lexicographic order and their counts,
+    compute the log posteriors the same way as `NGraphs.computePosteriors`,
+    as arrays: the prefixes (rows of N-1 code points) and, for each prefix,
+    a range given by `offsets` of characters (code points) and costs.  The
+    characters for each prefix include the reject class "~" and are sorted
+    by cost (and code point)."""
+    assert len(grams)>0
+    new = ones(len(grams),bool)
+    new[1:] = (grams[1:,:-1]!=grams[:-1,:-1]).any(axis=1)
+    starts = flatnonzero(new)
+    groups = cumsum(new)-1
+    totals = log(add.reduceat(counts,starts)+1)
+    chars = concatenate([grams[:,-1],zeros(len(starts),'uint32')+ord("~")])
+    costs = concatenate([totals[groups]-log(counts),totals])
+    groups = concatenate([groups,arange(len(starts))])
+    order = lexsort([chars,costs,groups])
+    offsets = concatenate([starts+arange(len(starts)),[len(chars)]])
+    return grams[starts,:-1],array(offsets,'<i4'),chars[order],costs[order]
+
 class NGraphs(NGraphsCounts):
     """A class representing n-graph models, that is
     $P(c_i | c_{i-1} ... c_{i_n})$, where the $c_i$ are
@@ -119,6 +345,25 @@ class NGraphs(NGraphsCounts):
         print "got",sum(counter.values()),"%d-graphs"%(n,)
         self.computePosteriors(counter)
         print "done building lposteriors"
+    def buildFromFilesParallel(self,fnames,n,linelimit=2000,parallel=1):
+        """Like `buildFromFiles`, but counts the n-graphs in
+        parallel with bounded memory (see `count_ngraphs`)."""
+        grams,counts = count_ngraphs(fnames,n,replacements=self.replacements,
+                                     linelimit=linelimit,parallel=parallel)
+        print "got",sum(counts),"%d-graphs"%(n,)
+        self.computePosteriorsFromCounts(grams,counts)
+        print "done building lposteriors"
+    def computePosteriorsFromCounts(self,grams,counts):
+        """Like `computePosteriors`, but given the n-graphs and their counts
+        as arrays (see `count_ngraphs`)."""
+        self.N = grams.shape[1]
+        prefixes,offsets,chars,costs = count_posteriors(grams,counts)
+        lposteriors = {}
+        for i,prefix in enumerate(prefixes):
+            lo,hi = offsets[i],offsets[i+1]
+            prefix = u"".join([unichr(c) for c in prefix])
+            lposteriors[prefix] = dict(zip([unichr(c) for c in chars[lo:hi]],costs[lo:hi].tolist()))
+        self.lposteriors = lposteriors
     def computePosteriors(self,counter):
         """Given a `counter` of all n-graphs, compute
         (log) conditional probabilities."""
@@ -157,7 +402,7 @@ class NGraphs(NGraphsCounts):
     def getLogPosteriors(self,s):
         """Return a dictionary mapping characters in the given context
         to negative log posterior probabilities."""
-        prefix = self.lineproc(s)[-self.N+1:]
+        prefix = self.context(s)
         return self.lposteriors.get(prefix,self.missing)
     def getBestGuesses(self,s,nother=5):
         """Get guesses for what the next character might be based on the current path."""
@@ -190,3 +435,153 @@ class NGraphsBackoff:
                           self.secondary.getLogPosteriors(s)])
     def getBestGuesses(self,s,nother=5):
         return self.primary.getBestGuesses(s,nother=nother)
+
+################################################################
+### Compiled n-graph models.
+###
+### The file contains a header, the pickled replacements, and then
+### three flat arrays: the sorted prefixes (N-1 characters each, stored
+### as big-endian 32 bit code points so that byte order is code point
+### order), offsets into the entries for each prefix, and the entries
+### themselves (character code points and costs, sorted by cost within
+### each prefix).  The arrays are memory mapped, so loading is fast and
+### processes using the same model share the pages.
+################################################################
+
+ngraphs_magic = "OCRNGR01"
+ngraphs_header = dtype([('magic','S8'),('N','<i4'),('nprefixes','<i4'),
+                        ('nentries','<i4'),('metalen','<i4')])
+ngraphs_align = 8
+
+def encode_prefix(prefix):
+    """Encode a prefix as a fixed-width byte string key."""
+    return array([ord(c) for c in prefix],'>u4').tostring()
+
+def aligned(n):
+    return (n+ngraphs_align-1)//ngraphs_align*ngraphs_align
+
+def is_compiled_ngraphs(fname):
+    with open(fname,"rb") as stream:
+        return stream.read(len(ngraphs_magic))==ngraphs_magic
+
+def write_compiled_ngraphs(fname,ngraphs):
+    """Write the n-graph model `ngraphs` (an `NGraphs` instance)
+    in the compiled format."""
+    N = ngraphs.N
+    keys = sorted([(encode_prefix(prefix),prefix) for prefix in ngraphs.lposteriors.keys()])
+    offsets = zeros(len(keys)+1,'<i4')
+    chars = []
+    costs = []
+    for i,(_,prefix) in enumerate(keys):
+        assert len(prefix)==N-1,"%r: bad prefix length"%(prefix,)
+        items = sorted([(p,ord(c)) for c,p in ngraphs.lposteriors[prefix].items()])
+        chars += [c for p,c in items]
+        costs += [p for p,c in items]
+        offsets[i+1] = len(chars)
+    write_compiled_arrays(fname,N,ngraphs.replacements,
+                          array([k for k,_ in keys],'S%d'%(4*(N-1))),offsets,chars,costs)
+
+def write_compiled_counts(fname,grams,counts,replacements=replacements):
+    """Write the model for the given n-graph counts (see `count_ngraphs`)
+    in the compiled format, without constructing the dictionaries."""
+    N = grams.shape[1]
+    prefixes,offsets,chars,costs = count_posteriors(grams,counts)
+    keys = ascontiguousarray(prefixes,'>u4').view('S%d'%(4*(N-1))).ravel()
+    write_compiled_arrays(fname,N,replacements,keys,offsets,chars,costs)
+
+def write_compiled_arrays(fname,N,replacements,keys,offsets,chars,costs):
+    meta = cPickle.dumps(dict(replacements=replacements),2)
+    header = zeros(1,ngraphs_header)
+    header[0] = (ngraphs_magic,N,len(keys),len(chars),len(meta))
+    arrays = [keys,array(offsets,'<i4'),array(chars,'<u4'),array(costs,'<f8')]
+    with open(fname,"wb") as stream:
+        stream.write(header.tostring())
+        stream.write(meta)
+        for a in arrays:
+            stream.write("\0"*(aligned(stream.tell())-stream.tell()))
+            stream.write(a.tostring())
+
+class CompiledPosteriors:
+    """Dictionary-like access to the posteriors in a compiled n-graph
+    model: maps a prefix to a dictionary of characters and costs.  The
+    dictionaries are constructed on demand and cached, since the search
+    asks for the same prefixes over and over."""
+    def __init__(self,keys,offsets,chars,costs,cachesize=100000):
+        self.prefixes = keys
+        self.offsets = offsets
+        self.chars = chars
+        self.costs = costs
+        self.width = keys.dtype.itemsize//4
+        self.cachesize = cachesize
+        self.cache = {}
+    def __len__(self):
+        return len(self.prefixes)
+    def lookup(self,prefix):
+        if len(prefix)!=self.width: return None
+        if isinstance(prefix,str):
+            # non-ASCII byte strings never compare equal to the unicode
+            # prefixes of the model, same as for the dictionaries
+            try: prefix = prefix.decode("ascii")
+            except UnicodeDecodeError: return None
+        # elements of string arrays come back without trailing NULs
+        key = encode_prefix(prefix).rstrip("\0")
+        i = searchsorted(self.prefixes,key)
+        if i>=len(self.prefixes) or self.prefixes[i]!=key: return None
+        lo,hi = self.offsets[i],self.offsets[i+1]
+        return dict(zip([unichr(c) for c in self.chars[lo:hi]],self.costs[lo:hi].tolist()))
+    def get(self,prefix,dflt=None):
+        result = self.cache.get(prefix)
+        if result is None:
+            if len(self.cache)>=self.cachesize: self.cache = {}
+            result = self.lookup(prefix)
+            self.cache[prefix] = result
+        return result if result is not None else dflt
+    def __getitem__(self,prefix):
+        result = self.get(prefix)
+        if result is None: raise KeyError(prefix)
+        return result
+    def __contains__(self,prefix):
+        return self.get(prefix) is not None
+    def keys(self):
+        return [unicode(k.ljust(4*self.width,"\0"),"utf-32-be") for k in self.prefixes]
+
+class CompiledNGraphs(NGraphs):
+    """An n-graph model loaded from the compiled format (see
+    `write_compiled_ngraphs`), with the same interface as `NGraphs`.
+    The arrays are memory mapped unless `mmap` is false."""
+    def __init__(self,fname,mmap=1):
+        with open(fname,"rb") as stream:
+            header = fromstring(stream.read(ngraphs_header.itemsize),ngraphs_header)[0]
+            assert header['magic']==ngraphs_magic,"%s: not a compiled n-graph model"%fname
+            meta = cPickle.loads(stream.read(header['metalen']))
+        NGraphs.__init__(self,N=int(header['N']),replacements=meta["replacements"])
+        if mmap:
+            data = memmap(fname,dtype='B',mode='r')
+        else:
+            data = fromfile(fname,dtype='B')
+        offset = ngraphs_header.itemsize+int(header['metalen'])
+        arrays = []
+        for dt,n in [('S%d'%(4*(self.N-1)),header['nprefixes']),('<i4',header['nprefixes']+1),
+                     ('<u4',header['nentries']),('<f8',header['nentries'])]:
+            dt = dtype(dt)
+            offset = aligned(offset)
+            arrays.append(data[offset:offset+n*dt.itemsize].view(dt))
+            offset += n*dt.itemsize
+        assert offset==len(data),"%s: bad file size"%fname
+        self.lposteriors = CompiledPosteriors(*arrays)
+
+def load_ngraphs(lmodel,verbose=1):
+    """Load a language model.  A model of the form `primary:secondary`
+    is loaded as an NGraphsBackoff model.  Compiled models (see
+    `write_compiled_ngraphs`) are memory mapped; anything else is
+    loaded as a pickle."""
+    if ":" in lmodel:
+        primary,secondary = [load_ngraphs(s,verbose=verbose) for s in lmodel.split(":")]
+        return NGraphsBackoff(primary,secondary)
+    lmodel = common.findfile(lmodel)
+    if verbose: print "loading",lmodel
+    assert os.path.exists(lmodel),"%s: cannot find language model"%lmodel
+    if is_compiled_ngraphs(lmodel):
+        return CompiledNGraphs(lmodel)
+    with open(lmodel) as stream:
+        return cPickle.load(stream)
@@ -0,0 +1,472 @@
+################################################################
+### Non-linear binarization of page images.  This is the
+### computation behind ocropus-nlbin, factored out so that it
+### can be used in-process (e.g., by ocropus-recognize-book).
+################################################################
+
+from pylab import *
+from scipy.ndimage import filters,interpolation,morphology
+from scipy import stats
+from common import Record
+import tempfile
+
+# default parameters; these correspond to the command line
+# options of ocropus-nlbin
+
+defaults = dict(
+    threshold = 0.5,
+    zoom = 0.5,
+    escale = 1.0,
+    bignore = 0.1,
+    perc = 80,
+    range = 20,
+    maxskew = 2,
+    gray = 0,
+    lo = 5,
+    hi = 90,
+    skewsteps = 8,
+    debug = 0,
+    quiet = 0,
+)
+
+def params(**kw):
+    """Return a parameter record with the defaults for the
+    binarizer, updated with any matching keyword arguments.
+    Keyword arguments that aren't binarization parameters are
+    ignored, so you can pass `**vars(args)`."""
+    p = dict(defaults)
+    p.update([(k,v) for k,v in kw.items() if k in defaults])
+    return Record(**p)
+
+def dshow(image,info,debug):
+    if debug<=0: return
+    ion(); gray(); imshow(image); title(info); ginput(1,debug)
+
+def running_percentile(image,perc,size,steps=3):
+    """Compute the same result as filters.percentile_filter (with the
+    default mode) for a uint8 image and a window of `size`, which should
+    be narrow in the second dimension, e.g. (20,2).
+
+    This slides the window down the image, keeping a histogram of
+    the window part in each column (with a coarse histogram of 16
+    levels on top).  Rather than searching the histograms for each pixel,
+    the percentile of the previous row is moved up or down by up to
+    `steps` levels; only the pixels where that isn't enough are searched.
+    Background images change slowly, so this is rarely needed.  To keep
+    the arrays long, the image is cut into horizontal bands that are
+    processed side by side."""
+    assert image.dtype==dtype('B')
+    h,w = image.shape
+    n,k = int(size[0]),int(size[1])
+    rank = n*k-1 if perc>=100 else int(n*k*perc/100.0)
+    bands = max(1,min(h//(4*n),65536//w))
+    l = (h+bands-1)//bands
+    padded = pad(image,((n//2,bands*l-h+n-n//2-1),(k//2,k-k//2-1)),mode='symmetric')
+    q = concatenate([padded[i*l:i*l+l+n-1] for i in range(bands)],axis=1)
+    q = array(q,'i')
+    m = bands*w
+    mi = q.shape[1]
+    # pixel j of an output row covers the input columns a[j]...a[j]+k-1
+    cols = arange(m)
+    a = (cols//w)*(w+k-1)+cols%w
+    fine = zeros(mi*256,'h')
+    coarse = zeros(mi*16,'h')
+    fine0,coarse0 = arange(mi)*256,arange(mi)*16
+    # the current percentile and the number of window pixels below it
+    v = zeros(m,'i')
+    lt = zeros(m,'h')
+    def update(row,d):
+        fine[fine0+row] += d
+        coarse[coarse0+(row>>4)] += d
+        for j in range(k):
+            if d>0: add(lt,row[a+j]<v,out=lt)
+            else: subtract(lt,row[a+j]<v,out=lt)
+    def count(which):
+        return sum([fine[(a[which]+j)*256+v[which]] for j in range(k)],axis=0)
+    def search(which):
+        ch = sum([coarse.reshape(mi,16)[a[which]+j] for j in range(k)],axis=0)
+        cum = cumsum(ch,axis=1)
+        b = (cum<=rank).sum(axis=1)
+        r = arange(len(which))
+        fh = sum([fine.reshape(mi,16,16)[a[which]+j,b] for j in range(k)],axis=0)
+        fc = cumsum(fh,axis=1)+(cum[r,b]-ch[r,b])[:,newaxis]
+        f = (fc<=rank).sum(axis=1)
+        v[which] = b*16+f
+        lt[which] = fc[r,f]-fh[r,f]
+    for y in range(n): update(q[y],1)
+    search(cols)
+    out = zeros((l,m),'B')
+    for y in range(l):
+        if y>0:
+            update(q[y+n-1],1)
+            which = flatnonzero((lt>rank)|(lt+count(cols)<=rank))
+            for i in range(steps):
+                if len(which)==0: break
+                down = (lt[which]>rank)
+                dn,up = which[down],which[~down]
+                v[dn] -= 1
+                lt[dn] -= count(dn)
+                lt[up] += count(up)
+                v[up] += 1
+                which = which[(lt[which]>rank)|(lt[which]+count(which)<=rank)]
+            if len(which)>0: search(which)
+        out[y] = v
+        update(q[y],-1)
+    out = concatenate([out[:,i*w:(i+1)*w] for i in range(bands)],axis=0)
+    return out[:h]
+
+def estimate_background(image,perc,size):
+    """Estimate the local whitelevel as the `perc` percentile over
+    `size` pixels vertically, then horizontally.  The image is quantized
+    to 256 levels between its minimum and maximum for this, so the result
+    is the same as for filters.percentile_filter up to quantization."""
+    lo,hi = amin(image),amax(image)
+    scale = (hi-lo)/255.0 if hi>lo else 1.0
+    q = array(clip((image-lo)/scale+0.5,0,255),'B')
+    q = running_percentile(q,perc,(size,2))
+    q = running_percentile(q.T.copy(),perc,(size,2)).T
+    # rescale in the precision of the input image
+    m = array(q,image.dtype)
+    m *= scale
+    m += lo
+    return m
+
+def skew_variance(sums,xs,angle,shape):
+    """The variance of the row means of the image rotated by `angle`,
+    computed from the row sums `sums` of narrow vertical strips centered
+    at `xs`.  Each strip is shifted as a whole to where
+    interpolation.rotate (with reshape=1) would move its center, which
+    amounts to a Radon transform of the strips."""
+    h,w = shape
+    r = angle*pi/180
+    c,s = cos(r),sin(r)
+    oh = int(h*c+w*abs(s)+0.5)
+    ow = int(w*c+h*abs(s)+0.5)
+    ys = arange(h)-(h/2.0-0.5)
+    rows = c*ys[:,newaxis]-s*(xs[newaxis,:]-(w/2.0-0.5))+(oh/2.0-0.5)
+    rows = clip(floor(rows+0.5),0,oh-1).astype('i')
+    v = bincount(rows.ravel(),weights=sums.ravel(),minlength=oh)[:oh]
+    return var(v/ow)
+
+def estimate_skew_angle(image,angles,debug=0,strip=16,coarse=4):
+    """Find the angle (among `angles`, in increasing order) that maximizes
+    the variance of the row means of the rotated image.  Rather than
+    rotating the image for each angle, the row sums of vertical strips of
+    `strip` pixels are computed once and shifted for each angle (see
+    `skew_variance`).  Only every `coarse`-th angle is tried at first;
+    the estimate is then refined using the angles around the best one."""
+    h,w = image.shape
+    starts = arange(0,w,strip)
+    sums = add.reduceat(image,starts,axis=1)
+    return estimate_skew_from_sums(sums,strip_centers(w,strip),image.shape,angles,
+                                   debug=debug,coarse=coarse)
+
+def strip_centers(w,strip):
+    """The centers of the vertical strips of an image of width `w`."""
+    starts = arange(0,w,strip)
+    return (starts+minimum(starts+strip,w))/2.0-0.5
+
+def estimate_skew_from_sums(sums,xs,shape,angles,debug=0,coarse=4):
+    """Like estimate_skew_angle, given the row sums of the strips
+    centered at `xs` of an image of the given shape."""
+    estimates = {}
+    def evaluate(indexes):
+        for i in indexes:
+            if i in estimates: continue
+            estimates[i] = skew_variance(sums,xs,angles[i],shape)
+        return max([(estimates[i],angles[i],i) for i in indexes])
+    n = len(angles)
+    _,_,best = evaluate(sorted(set(range(0,n,coarse)+[n-1])))
+    _,a,_ = evaluate(range(max(0,best-coarse+1),min(n,best+coarse)))
+    if debug>0:
+        tried = sorted(estimates.keys())
+        plot([angles[i] for i in tried],[estimates[i] for i in tried])
+        ginput(1,debug)
+    return a
+
+def binarize(raw,**kw):
+    """Binarize a grayscale page image.  Returns a record with
+    the normalized grayscale image (`flat`), the binary image (`bin`),
+    the estimated black and white levels (`lo`, `hi`), the
+    skew `angle`, and a `comment` about the processing.
+    A single precision `raw` image is processed in single precision
+    throughout; the binary image is returned as bytes.
+    Parameters are as for ocropus-nlbin (see `defaults`)."""
+    p = params(**kw)
+    comment = ""
+    dshow(raw,"input",p.debug)
+    # perform image normalization
+    image = raw-amin(raw)
+    image /= amax(image)
+
+    # check whether the image is already effectively binarized
+    if p.gray:
+        extreme = 0
+    else:
+        extreme = (sum(image<0.05)+sum(image>0.95))*1.0/prod(image.shape)
+    if extreme>0.95:
+        comment += " no-normalization"
+        flat = image
+    else:
+        # if not, we need to flatten it by estimating the local whitelevel
+        if not p.quiet: print "flattening"
+        m = interpolation.zoom(image,p.zoom)
+        m = estimate_background(m,p.perc,p.range)
+        m = interpolation.zoom(m,1.0/p.zoom)
+        if p.debug>0: clf(); imshow(m,vmin=0,vmax=1); ginput(1,p.debug)
+        w,h = minimum(array(image.shape),array(m.shape))
+        flat = clip(image[:w,:h]-m[:w,:h]+1,0,1)
+        if p.debug>0: clf(); imshow(flat,vmin=0,vmax=1); ginput(1,p.debug)
+
+    # estimate skew angle and rotate
+    if p.maxskew>0:
+        if not p.quiet: print "estimating skew angle"
+        d0,d1 = flat.shape
+        o0,o1 = int(p.bignore*d0),int(p.bignore*d1)
+        flat = amax(flat)-flat
+        flat -= amin(flat)
+        est = flat[o0:d0-o0,o1:d1-o1]
+        ma = p.maxskew
+        ms = int(2*p.maxskew*p.skewsteps)
+        angle = estimate_skew_angle(est,linspace(-ma,ma,ms+1),debug=p.debug)
+        flat = interpolation.rotate(flat,angle,mode='constant',reshape=0)
+        flat = amax(flat)-flat
+    else:
+        angle = 0
+
+    # estimate low and high thresholds
+    if not p.quiet: print "estimating thresholds"
+    d0,d1 = flat.shape
+    o0,o1 = int(p.bignore*d0),int(p.bignore*d1)
+    est = flat[o0:d0-o0,o1:d1-o1]
+    if p.escale>0:
+        # by default, we use only regions that contain
+        # significant variance; this makes the percentile
+        # based low and high estimates more reliable
+        e = p.escale
+        v = est-filters.gaussian_filter(est,e*20.0)
+        v = filters.gaussian_filter(v**2,e*20.0)**0.5
+        v = (v>0.3*amax(v))
+        v = morphology.binary_dilation(v,structure=ones((int(e*50),1)))
+        v = morphology.binary_dilation(v,structure=ones((1,int(e*50))))
+        if p.debug>0: imshow(v); ginput(1,p.debug)
+        est = est[v]
+    lo = stats.scoreatpercentile(est.ravel(),p.lo)
+    hi = stats.scoreatpercentile(est.ravel(),p.hi)
+
+    # rescale the image to get the gray scale image
+    if not p.quiet: print "rescaling"
+    flat -= lo
+    flat /= (hi-lo)
+    flat = clip(flat,0,1)
+    if p.debug>0: imshow(flat,vmin=0,vmax=1); ginput(1,p.debug)
+    bin = array(flat>p.threshold,'B')
+    return Record(flat=flat,bin=bin,lo=lo,hi=hi,angle=angle,comment=comment)
+
+################################################################
+### Tiled binarization.  This performs the same steps as `binarize`,
+### but only ever converts tiles of the page (plus a halo of the
+### size of the filters involved) to floating point.  The intermediate
+### page images are kept in memory mapped temporary files.
+################################################################
+
+def scratch(shape,dtype='float32',dir=None):
+    """A temporary array backed by a file, so that it can be paged out."""
+    return memmap(tempfile.TemporaryFile(dir=dir),dtype=dtype,mode='w+',shape=shape)
+
+def tiles(shape,tilesize):
+    """Iterate over the boxes (y0,x0,y1,x1) of the tiles covering an image."""
+    h,w = shape
+    for y in range(0,h,tilesize):
+        for x in range(0,w,tilesize):
+            yield y,x,min(y+tilesize,h),min(x+tilesize,w)
+
+def expand(box,d,bounds):
+    """Expand the box by `d` pixels, but not beyond the `bounds` box."""
+    y0,x0,y1,x1 = box
+    b0,b1,b2,b3 = bounds
+    return max(y0-d,b0),max(x0-d,b1),min(y1+d,b2),min(x1+d,b3)
+
+def crop(box,outer):
+    """The slices that extract `box` from an array covering `outer`."""
+    return (slice(box[0]-outer[0],box[2]-outer[0]),slice(box[1]-outer[1],box[3]-outer[1]))
+
+def region(image,box):
+    return image[box[0]:box[2],box[1]:box[3]]
+
+def tile_gray(raw,box):
+    """Extract a tile of a raw (byte, short, float, or RGB) image as
+    a floating point grayscale image, scaled like read_image_gray."""
+    a = region(raw,box)
+    if a.ndim==3: a = mean(a,axis=2)
+    if raw.dtype==dtype('B'): return a/255.0
+    if raw.dtype==dtype('uint16'): return a/65536.0
+    return array(a,'f8')
+
+def gray_bytes(raw,tilesize=1024):
+    """Convert a raw image to a grayscale byte image (as write_image_gray
+    would convert the result of read_image_gray), one tile at a time."""
+    h,w = raw.shape[:2]
+    result = zeros((h,w),'B')
+    for box in tiles((h,w),tilesize):
+        region(result,box)[:,:] = 255*clip(tile_gray(raw,box),0.0,1.0)
+    return result
+
+def histogram_percentile(hist,lo,hi,perc):
+    """The percentile (interpolated as for stats.scoreatpercentile) of the
+    values counted in `hist`, whose bins cover `lo` to `hi`."""
+    cum = cumsum(hist)
+    n = cum[-1]
+    index = perc/100.0*(n-1)
+    k = int(floor(index))
+    width = (hi-lo)*1.0/len(hist)
+    v0,v1 = [lo+(searchsorted(cum,j,'right')+0.5)*width for j in (k,min(k+1,n-1))]
+    return v0+(index-k)*(v1-v0)
+
+def binarize_tiled(raw,tilesize=1024,**kw):
+    """Binarize a page image tile by tile, bounding the memory used for
+    floating point temporaries.  The raw image can be an array of bytes
+    (e.g., as returned by pil2array), which is converted to grayscale
+    one tile at a time.  Returns a record as for `binarize`, but with
+    the normalized image `flat` and the binary image `bin` as byte arrays.
+    The result differs from `binarize` by small amounts near tile
+    boundaries (the background is estimated separately for each tile)
+    and because the black and white levels are estimated from histograms."""
+    p = params(**kw)
+    comment = ""
+    h,w = raw.shape[:2]
+    page = (0,0,h,w)
+    boxes = list(tiles((h,w),tilesize))
+
+    # image normalization
+    lo0 = min([amin(tile_gray(raw,b)) for b in boxes])
+    hi0 = max([amax(tile_gray(raw,b)) for b in boxes])
+    scale0 = 1.0/(hi0-lo0) if hi0>lo0 else 1.0
+    def image(box):
+        return (tile_gray(raw,box)-lo0)*scale0
+    if p.gray:
+        extreme = 0
+    else:
+        extreme = 0
+        for b in boxes:
+            a = image(b)
+            extreme += sum(a<0.05)+sum(a>0.95)
+        extreme = extreme*1.0/(h*w)
+
+    # flatten the image, keeping the row sums of vertical strips
+    # of the inner part of the page for skew estimation
+    o0,o1 = int(p.bignore*h),int(p.bignore*w)
+    estbox = (o0,o1,h-o0,w-o1)
+    strip = 16
+    sums = zeros((max(estbox[2]-o0,0),(max(estbox[3]-o1,0)+strip-1)//strip))
+    flat = scratch((h,w))
+    if extreme>0.95:
+        comment += " no-normalization"
+    elif not p.quiet: print "flattening"
+    # the zoomed tiles are sampled on the same grid as for zooming the
+    # whole page, and zoomed back like the whole page would be
+    halo = int(p.range/p.zoom)+16
+    zh,zw = int(round(h*p.zoom)),int(round(w*p.zoom))
+    down = array([(h-1.0)/max(zh-1,1),(w-1.0)/max(zw-1,1)])
+    up = array([(zh-1.0)/max(int(round(zh/p.zoom))-1,1),(zw-1.0)/max(int(round(zw/p.zoom))-1,1)])
+    for box in boxes:
+        if extreme>0.95:
+            region(flat,box)[:,:] = image(box)
+        else:
+            outer = expand(box,halo,page)
+            sub = image(outer)
+            z0 = array(ceil(array(outer[:2])/down),'i')
+            z1 = array(floor((array(outer[2:])-1)/down),'i')+1
+            m = interpolation.affine_transform(sub,diag(down),offset=z0*down-outer[:2],output_shape=tuple(z1-z0))
+            m = estimate_background(m,p.perc,p.range)
+            m = interpolation.affine_transform(m,diag(up),offset=array(box[:2])*up-z0,
+                                               output_shape=(box[2]-box[0],box[3]-box[1]))
+            region(flat,box)[:,:] = clip(sub[crop(box,outer)]-m+1,0,1)
+        inner = expand(box,0,estbox)
+        if inner[0]<inner[2] and inner[1]<inner[3]:
+            starts = arange((inner[1]-o1)//strip*strip,inner[3]-o1,strip)
+            starts[0] = inner[1]-o1
+            s = add.reduceat(region(flat,inner),starts-(inner[1]-o1),axis=1)
+            sums[inner[0]-o0:inner[2]-o0,starts//strip] += s
+    fmax = max([amax(region(flat,b)) for b in boxes])
+
+    # estimate the skew angle of the inverted image and rotate it
+    if p.maxskew>0:
+        if not p.quiet: print "estimating skew angle"
+        widths = diff(minimum(arange(0,sums.shape[1]+1)*strip,estbox[3]-o1))
+        ma = p.maxskew
+        ms = int(2*p.maxskew*p.skewsteps)
+        angle = estimate_skew_from_sums(fmax*widths[newaxis,:]-sums,strip_centers(estbox[3]-o1,strip),
+                                        (estbox[2]-o0,estbox[3]-o1),linspace(-ma,ma,ms+1))
+        r = angle*pi/180
+        c,s = cos(r),sin(r)
+        matrix = array([[c,s],[-s,c]])
+        center = array([h/2.0-0.5,w/2.0-0.5])
+        rotated = scratch((h,w))
+        for box in boxes:
+            corners = [dot(matrix,array(y_x)-center)+center for y_x in
+                       [(box[0],box[1]),(box[0],box[3]),(box[2],box[1]),(box[2],box[3])]]
+            lo_,hi_ = amin(corners,axis=0),amax(corners,axis=0)
+            outer = (int(floor(lo_[0])),int(floor(lo_[1])),int(ceil(hi_[0]))+1,int(ceil(hi_[1]))+1)
+            outer = expand(outer,16,page)
+            if outer[0]>=outer[2] or outer[1]>=outer[3]:
+                region(rotated,box)[:,:] = 0
+                continue
+            sub = fmax-region(flat,outer)
+            offset = dot(matrix,array(box[:2])-center)+center-array(outer[:2])
+            region(rotated,box)[:,:] = interpolation.affine_transform(sub,matrix,offset=offset,
+                                                                       output_shape=(box[2]-box[0],box[3]-box[1]),
+                                                                       mode='constant')
+        rmax = max([amax(region(rotated,b)) for b in boxes])
+        flat = rotated
+        def final(box): return rmax-region(flat,box)
+    else:
+        angle = 0
+        def final(box): return array(region(flat,box))
+
+    # estimate low and high thresholds from a histogram of the
+    # inner part of the page (by default, only of regions with
+    # significant variance)
+    if not p.quiet: print "estimating thresholds"
+    inner = [b for b in [expand(b,0,estbox) for b in boxes] if b[0]<b[2] and b[1]<b[3]]
+    vmin = min([amin(final(b)) for b in inner])
+    vmax = max([amax(final(b)) for b in inner])
+    nbins = 65536
+    hist = zeros(nbins)
+    def accumulate(values):
+        bins = clip(array((values-vmin)*(nbins/max(vmax-vmin,1e-9)),'i'),0,nbins-1)
+        hist[:] += bincount(bins.ravel(),minlength=nbins)
+    if p.escale>0:
+        e = p.escale
+        def variance(outer):
+            est = final(outer)
+            v = est-filters.gaussian_filter(est,e*20.0)
+            return filters.gaussian_filter(v**2,e*20.0)**0.5
+        vhalo = int(e*160)+4
+        dhalo = int(e*50)
+        varimage = scratch((estbox[2]-o0,estbox[3]-o1))
+        shifted = lambda b:(b[0]-o0,b[1]-o1,b[2]-o0,b[3]-o1)
+        for b in inner:
+            outer = expand(b,vhalo,estbox)
+            region(varimage,shifted(b))[:,:] = variance(outer)[crop(b,outer)]
+        vthresh = 0.3*amax([amax(region(varimage,shifted(b))) for b in inner])
+        for b in inner:
+            outer = expand(b,dhalo,estbox)
+            v = (region(varimage,shifted(outer))>vthresh)
+            v = morphology.binary_dilation(v,structure=ones((int(e*50),1)))
+            v = morphology.binary_dilation(v,structure=ones((1,int(e*50))))
+            accumulate(final(b)[v[crop(b,outer)]])
+    else:
+        for b in inner: accumulate(final(b))
+    lo = histogram_percentile(hist,vmin,vmax,p.lo)
+    hi = histogram_percentile(hist,vmin,vmax,p.hi)
+
+    # rescale the image to get the gray scale image
+    if not p.quiet: print "rescaling"
+    gray = zeros((h,w),'B')
+    bin = zeros((h,w),'B')
+    for box in boxes:
+        f = clip((final(box)-lo)/(hi-lo),0,1)
+        region(gray,box)[:,:] = 255*f
+        region(bin,box)[:,:] = (f>p.threshold)
+    return Record(flat=gray,bin=bin,lo=lo,hi=hi,angle=angle,comment=comment)
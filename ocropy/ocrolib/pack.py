@@ -0,0 +1,212 @@
+################################################################
+### Book packs.  A pack is a single file holding the files of a
+### book directory (page and line images, lattices, text, etc.),
+### so that a book doesn't turn into hundreds of thousands of
+### small files.  The files in a pack are addressed by paths that
+### go through the pack as if it were a directory, for example
+### "book.pack/0001/010001.bin.png".  The functions below accept
+### both such paths and ordinary paths.
+###
+### A pack is append-only.  It starts with a magic string, and each
+### file is stored as a record consisting of a header (a tag and the
+### lengths of the name and the contents), the name, and the contents.
+### Writing a file again appends a new record that supersedes the old
+### one.  Appends are serialized with a lock on the pack, so several
+### processes can write to the same pack.  The offset index of the
+### records is built from the record headers when a pack is first
+### used, and is extended whenever the pack has grown.
+################################################################
+
+import os,re,io,fnmatch,posixpath,struct,fcntl
+import glob as pyglob
+
+pack_magic = "OCROPK01"
+record_tag = "FILE"
+record_header = struct.Struct("<4sII")
+
+class Pack:
+    """An append-only pack file and the offset index of its records."""
+    def __init__(self,fname):
+        self.fname = fname
+        self.index = {}
+        self.dirs = set()
+        self.end = len(pack_magic)
+    def add(self,name,start,n):
+        """Enter a record into the index and its directories into the
+        directory set."""
+        self.index[name] = (start,n)
+        while "/" in name:
+            name = name.rsplit("/",1)[0]
+            if name in self.dirs: break
+            self.dirs.add(name)
+    def refresh(self,stream=None):
+        """Add the records appended since the last refresh to the index.
+        A record that is still being written is left for the next refresh."""
+        if stream is None:
+            if not os.path.exists(self.fname): return
+            with open(self.fname,"rb") as stream:
+                return self.refresh(stream)
+        size = os.fstat(stream.fileno()).st_size
+        if size<=self.end: return
+        if self.end==len(pack_magic):
+            stream.seek(0)
+            if stream.read(len(pack_magic))!=pack_magic:
+                raise IOError("%s: not a pack file"%self.fname)
+        pos = self.end
+        while pos+record_header.size<=size:
+            stream.seek(pos)
+            tag,nname,ndata = record_header.unpack(stream.read(record_header.size))
+            if tag!=record_tag:
+                raise IOError("%s: bad record at offset %d"%(self.fname,pos))
+            start = pos+record_header.size+nname
+            if start+ndata>size: break
+            name = stream.read(nname)
+            self.add(name,start,ndata)
+            pos = start+ndata
+        self.end = pos
+    def names(self):
+        """The sorted names of the files in the pack."""
+        self.refresh()
+        return sorted(self.index.keys())
+    def exists(self,name):
+        """Whether the name is a file or a directory in the pack."""
+        if name=="": return os.path.exists(self.fname)
+        if name not in self.index and name not in self.dirs: self.refresh()
+        return name in self.index or name in self.dirs
+    def isdir(self,name):
+        """Whether any file in the pack is below the given directory."""
+        if name=="": return os.path.exists(self.fname)
+        if name not in self.dirs: self.refresh()
+        return name in self.dirs
+    def locate(self,name):
+        """The offset and length of the contents of the file."""
+        if name not in self.index: self.refresh()
+        if name not in self.index:
+            raise IOError("%s: no such file in %s"%(name,self.fname))
+        return self.index[name]
+    def read(self,name):
+        with open(self.fname,"rb") as stream:
+            # another process may have replaced the file
+            self.refresh(stream)
+            if name not in self.index:
+                raise IOError("%s: no such file in %s"%(name,self.fname))
+            start,n = self.index[name]
+            stream.seek(start)
+            return stream.read(n)
+    def write(self,name,data):
+        with open(self.fname,"ab") as stream:
+            fcntl.lockf(stream.fileno(),fcntl.LOCK_EX)
+            try:
+                stream.seek(0,2)
+                pos = stream.tell()
+                if pos==0:
+                    stream.write(pack_magic)
+                    pos = len(pack_magic)
+                stream.write(record_header.pack(record_tag,len(name),len(data))+name+data)
+                stream.flush()
+            finally:
+                fcntl.lockf(stream.fileno(),fcntl.LOCK_UN)
+        self.add(name,pos+record_header.size+len(name),len(data))
+
+class PackWriter(io.BytesIO):
+    """A file-like object that stores its contents in the
+    pack when it is closed."""
+    def __init__(self,pack,name):
+        io.BytesIO.__init__(self)
+        self.pack = pack
+        self.name = name
+    def write(self,data):
+        if isinstance(data,unicode): data = data.encode("utf-8")
+        return io.BytesIO.write(self,data)
+    def close(self):
+        if not self.closed: self.pack.write(self.name,self.getvalue())
+        io.BytesIO.close(self)
+
+# the packs in use, by absolute path
+packs = {}
+
+def split(path):
+    """Split a path going through a pack into the pack and the
+    name of the file in it.  Returns None for other paths."""
+    match = re.match(r'^(.*?\.pack)(?:/+(.*))?$',path)
+    if match is None or os.path.isdir(match.group(1)): return None
+    fname,name = match.groups()
+    name = posixpath.normpath(name) if name else ""
+    if name==".": name = ""
+    key = os.path.abspath(fname)
+    if key not in packs: packs[key] = Pack(fname)
+    return packs[key],name
+
+def open_file(path,mode="r"):
+    """Open a file for reading or writing, like `open`."""
+    where = split(path)
+    if where is None: return open(path,mode)
+    p,name = where
+    if mode in ["r","rb","rU"]: return io.BytesIO(p.read(name))
+    if mode in ["w","wb"]: return PackWriter(p,name)
+    raise ValueError("%s: mode %s is not supported for files in packs"%(path,mode))
+
+def exists(path):
+    where = split(path)
+    if where is None: return os.path.exists(path)
+    p,name = where
+    return p.exists(name)
+
+def isdir(path):
+    where = split(path)
+    if where is None: return os.path.isdir(path)
+    p,name = where
+    return p.isdir(name)
+
+def makedirs(path):
+    """Create a directory (and its parents) unless it exists.  Directories
+    in packs exist implicitly, so nothing needs to be done for them."""
+    if split(path) is not None: return
+    if not os.path.exists(path): os.makedirs(path)
+
+def locate(path):
+    """For a file in a pack, return the pack file name and the offset and
+    length of the file's contents (e.g., for memory mapping them);
+    returns None for other paths."""
+    where = split(path)
+    if where is None: return None
+    p,name = where
+    start,n = p.locate(name)
+    return p.fname,start,n
+
+def glob(pattern):
+    """Like glob.glob, but also expands patterns going through packs."""
+    match = re.match(r'^(.*?\.pack)/+(.*)$',pattern)
+    if match is None: return pyglob.glob(pattern)
+    result = []
+    for fname in pyglob.glob(match.group(1)):
+        if os.path.isdir(fname):
+            result += pyglob.glob(fname+"/"+match.group(2))
+            continue
+        p,_ = split(fname)
+        parts = match.group(2).split("/")
+        for name in p.names():
+            names = name.split("/")
+            if len(names)==len(parts) and all([fnmatch.fnmatchcase(n,q) for n,q in zip(names,parts)]):
+                result.append(fname+"/"+name)
+    return result
+
+def export(fname,directory):
+    """Write the files in the pack to a directory (which
+    gets the usual layout of a book directory)."""
+    p,_ = split(fname)
+    for name in p.names():
+        path = os.path.join(directory,name)
+        makedirs(os.path.dirname(path))
+        with open(path,"wb") as stream:
+            stream.write(p.read(name))
+
+def add_directory(fname,directory):
+    """Add all the files in a directory (e.g., a book directory) to the pack."""
+    p,_ = split(fname)
+    for root,dirs,files in os.walk(directory):
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(root,f)
+            with open(path,"rb") as stream:
+                p.write(os.path.relpath(path,directory),stream.read())
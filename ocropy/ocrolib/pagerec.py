@@ -0,0 +1,161 @@
+################################################################
+### In-process page recognition: binarization, page segmentation,
+### line recognition and language modeling, without going through
+### intermediate files.  This performs the same steps as running
+### ocropus-nlbin, ocropus-gpageseg, ocropus-lattices, and
+### ocropus-ngraphs in sequence, but the models are loaded only once.
+################################################################
+
+import os
+from pylab import *
+import common
+from common import Record,RecognitionError
+import nlbin,pageseg,linerec,lmsearch,hocr,default
+import ngraphs as ng
+from lattice import Lattice2
+
+# default parameters for the language model search; these
+# correspond to the command line options of ocropus-ngraphs
+
+lattice_defaults = dict(maxws=8,maxcost=15.0,mismatch=8,wsfactor=1.0)
+search_defaults = dict(cweight=1.0,lweight=0.1,beam=10,thresh=0.0,
+                       other=15.0,nother=1,lother=0.1,nbest=5)
+
+class PageRecognizer:
+    """Recognizes page images and text line images.  This keeps the
+    line recognizer and language model in memory.  Parameters for the
+    individual steps are passed as dictionaries with the same names as
+    the command line options of the corresponding ocropus commands."""
+    def __init__(self,linerec,ngraphs,binarize={},pageseg={},lattice={},search={}):
+        self.linerec = linerec
+        self.ngraphs = ngraphs
+        self.contexts = lmsearch.Contexts(ngraphs)
+        self.binarize_params = dict(quiet=1,**binarize)
+        self.pageseg_params = dict(quiet=1,**pageseg)
+        self.lattice_params = dict(lattice_defaults,**lattice)
+        self.search_params = dict(search_defaults,**search)
+    def binarize(self,raw):
+        """Binarize a raw page image; see `nlbin.binarize`."""
+        return nlbin.binarize(raw,**self.binarize_params)
+    def segment(self,bin):
+        """Segment a binarized page image (text=0) into lines; see
+        `pageseg.segment_page`.  The result also contains the list
+        of extracted line images (`binlines`, as written by ocropus-gpageseg)
+        and the corresponding binary line `images` (as float, text=0)."""
+        binary = 1-bin
+        result = pageseg.segment_page(binary,**self.pageseg_params)
+        binlines,_ = pageseg.extract_lines(binary,result.lines,**self.pageseg_params)
+        result.binlines = binlines
+        result.images = [1.0*(l>common.midrange(l)) for l in binlines]
+        return result
+    def search(self,lattice):
+        """Find the best path through a recognition lattice (a list of
+        segments) under the language model.  Returns the text and the path."""
+        return self.search_graph(Lattice2(**self.lattice_params).setSegments(lattice))
+    def search_file(self,fname):
+        """Like `search`, but reads the lattice from a .lattice file."""
+        return self.search_graph(Lattice2(**self.lattice_params).readLattice(fname))
+    def search_graph(self,graph):
+        paths = lmsearch.search(graph,self.ngraphs,contexts=self.contexts,**self.search_params)
+        path = paths[0]
+        # strip the initial context (we prepend "____" to create the line startup context)
+        return path.path[self.ngraphs.N:],path
+    def recognize_line(self,image):
+        """Recognize a text line image (float, text=0).  Returns the line
+        recognition result (see `LineRecognizer.recognize`) with the
+        additional fields `text` and `path`."""
+        result = self.linerec.recognize(image)
+        result.text,result.path = self.search(result.lattice)
+        return result
+    def recognize_page(self,raw,verbose=0):
+        """Recognize a grayscale page image.  Returns a record containing
+        the binarization (`page`), the segmentation (`seg`), and a list
+        of `lines`, in reading order; each line is the result of
+        `recognize_line`, with the line `id`, or None if the line
+        could not be recognized."""
+        page = self.binarize(raw)
+        seg = self.segment(page.bin)
+        lines = []
+        for i,image in enumerate(seg.images):
+            try:
+                line = self.recognize_line(image)
+                line.id = 0x010000+(i+1)
+            except RecognitionError,e:
+                if verbose: print "    *** line %06x: %s ***"%(0x010000+(i+1),e)
+                line = None
+            lines.append(line)
+        return Record(page=page,seg=seg,lines=lines)
+
+def load_pagerec(model=None,whitespace=None,lineest=None,segmenter=None,lmodel=None,quiet=0,**kw):
+    """Load the line recognition models and the language model (using
+    the defaults if none are given) and return a PageRecognizer.  Additional
+    keyword arguments are passed to the PageRecognizer."""
+    recognizer = linerec.load_linerec(model=model,whitespace=whitespace,lineest=lineest,
+                                      segmenter=segmenter,quiet=quiet)
+    ngraphs = ng.load_ngraphs(lmodel or default.ngraphs,verbose=not quiet)
+    return PageRecognizer(recognizer,ngraphs,**kw)
+
+def write_lattice(base,line):
+    """Write the line recognition results (see `LineRecognizer.recognize`)
+    in the same files that ocropus-lattices produces."""
+    with common.open_file(base+".lattice","w") as stream:
+        linerec.write_lattice(stream,line.lattice)
+    common.write_line_segmentation(base+".rseg.png",line.rseg)
+    common.write_text(base+".xheight","%.1f"%line.xheight)
+    common.write_text(base+".baseline",line.baseline)
+
+def write_text(base,text,path,rseg=None):
+    """Write the language model results in the same files that
+    ocropus-ngraphs produces; the character segmentation is only
+    written if the raw segmentation `rseg` is given."""
+    common.write_text(base+".txt",text)
+    if rseg is None: return
+    cseg,ctxt = lmsearch.compute_cseg(path,rseg)
+    common.write_line_segmentation(base+".cseg.png",cseg)
+    common.write_text(base+".aligned",common.gt_implode(ctxt))
+
+def write_line(base,line):
+    """Write the recognition results for a text line in the same
+    files that ocropus-lattices and ocropus-ngraphs produce."""
+    write_lattice(base,line)
+    write_text(base,line.text,line.path,line.rseg)
+
+def write_page(base,result):
+    """Write the results of `recognize_page` in the same files and
+    directory layout that ocropus-nlbin, ocropus-gpageseg,
+    ocropus-lattices, and ocropus-ngraphs produce."""
+    common.write_image_binary(base+".bin.png",result.page.bin)
+    common.write_image_gray(base+".nrm.png",result.page.flat)
+    common.write_page_segmentation(base+".pseg.png",result.seg.segmentation)
+    common.fmkdir(base)
+    for i,binline in enumerate(result.seg.binlines):
+        lbase = "%s/01%04x"%(base,i+1)
+        common.write_image_binary(lbase+".bin.png",binline)
+        if result.lines[i] is not None:
+            write_line(lbase,result.lines[i])
+
+def hocr_lines(result):
+    """Given the results of `recognize_page`, return the information
+    needed for hOCR output as a list of (bbox,text,xheight,baseline)
+    tuples in reading order; text is None for lines that couldn't be
+    recognized.  This is much smaller than the full result."""
+    lines = dict([(l.id,l) for l in result.lines if l is not None])
+    output = []
+    for id,bbox in hocr.page_lines(result.seg.segmentation):
+        line = lines.get(id)
+        if line is None:
+            output.append((bbox,None,None,None))
+        else:
+            output.append((bbox,line.text,line.xheight,line.baseline))
+    return output
+
+def write_hocr(writer,name,lines):
+    """Output a page as hOCR, given the lines computed by `hocr_lines`."""
+    writer.begin_page(name)
+    try:
+        for bbox,text,xheight,baseline in lines:
+            writer.paragraph(bbox)
+            if text is None: continue
+            writer.line(bbox,text,xheight=xheight,baseline=baseline)
+    finally:
+        writer.end_page()
@@ -0,0 +1,293 @@
+################################################################
+### Page segmentation into columns and text lines.  This is the
+### computation behind ocropus-gpageseg, factored out so that it
+### can be used in-process (e.g., by ocropus-recognize-book).
+################################################################
+
+from pylab import *
+from scipy.ndimage.filters import gaussian_filter,uniform_filter,maximum_filter
+import common
+from common import Record,RecognitionError
+import psegutils,morph,improc,sl,ccstats
+
+# default parameters; these correspond to the command line
+# options of ocropus-gpageseg
+
+defaults = dict(
+    minscale = 12.0,
+    maxlines = 300,
+    scale = 0.0,
+    hscale = 1.0,
+    vscale = 1.0,
+    threshold = 0.2,
+    noise = 8,
+    usegauss = 0,
+    maxseps = 2,
+    sepwiden = 10,
+    maxcolseps = 2,
+    csmaxwidth = 10,
+    csminheight = 20,
+    pad = 3,
+    expand = 3,
+    quiet = 0,
+    debugcleaned = 0,
+    debuglines = 0,
+    debugreadingorder = 0,
+    debugseps = 0,
+    debugcolseps = 0,
+    debugcols = 0,
+)
+
+def params(**kw):
+    """Return a parameter record with the defaults for the
+    page segmenter, updated with any matching keyword arguments.
+    Keyword arguments that aren't page segmentation parameters are
+    ignored, so you can pass `**vars(args)`."""
+    p = dict(defaults)
+    p.update([(k,v) for k,v in kw.items() if k in defaults])
+    return Record(**p)
+
+def B(a):
+    if a.dtype==dtype('B'): return a
+    return array(a,'B')
+
+def imfigure(title,image):
+    figure(title)
+    gray()
+    imshow(image)
+    ginput(1,0.1)
+
+
+
+################################################################
+### Column finding.
+###
+### This attempts to find column separators, either as extended
+### vertical black lines or extended vertical whitespace.
+### It will work fairly well in simple cases, but for unusual
+### documents, you need to tune the parameters.
+################################################################
+
+def compute_separators_morph(binary,scale,p):
+    """Finds vertical black lines corresponding to column separators."""
+    d0 = int(max(5,scale/4))
+    d1 = int(max(5,scale))+p.sepwiden
+    thick = morph.r_dilation(binary,(d0,d1))
+    vert = morph.rb_opening(thick,(10*scale,1))
+    vert = morph.r_erosion(vert,(d0//2,p.sepwiden))
+    vert = morph.select_regions(vert,sl.dim1,min=3,nbest=2*p.maxseps)
+    vert = morph.select_regions(vert,sl.dim0,min=20*scale,nbest=p.maxseps)
+    return vert
+
+def compute_colseps_morph(binary,scale,p):
+    """Finds extended vertical whitespace corresponding to column separators."""
+    boxmap = psegutils.compute_boxmap(binary,scale,dtype='B')
+    bounds = morph.rb_closing(B(boxmap),(int(5*scale),int(5*scale)))
+    bounds = maximum(B(1-bounds),B(boxmap))
+    cols = 1-morph.rb_closing(boxmap,(int(20*scale),int(scale)))
+    cols = morph.select_regions(cols,lambda x:-sl.dim1(x),min=-p.csmaxwidth*scale)
+    cols = morph.select_regions(cols,sl.dim0,min=p.csminheight*scale,nbest=p.maxcolseps)
+    cols = morph.r_erosion(cols,(int(0.5+scale),0))
+    cols = morph.r_dilation(cols,(int(0.5+scale),0),origin=(int(scale/2)-1,0))
+    return cols
+
+def compute_colseps(binary,scale,p):
+    """Computes column separators either from vertical black lines or whitespace."""
+    seps = compute_separators_morph(binary,scale,p)
+    if p.debugcols: imfigure("column separators",0.7*seps+0.3*binary)
+    colseps = compute_colseps_morph(binary,scale,p)
+    if p.debugcols: imfigure("column whitespace separators",0.7*colseps+0.3*binary)
+    colseps = maximum(colseps,seps)
+    binary = minimum(binary,1-seps)
+    return colseps,binary
+
+
+
+################################################################
+### Text Line Finding.
+###
+### This identifies the tops and bottoms of text lines by
+### computing gradients and performing some adaptive thresholding.
+### Those components are then used as seeds for the text lines.
+################################################################
+
+def compute_gradmaps(binary,scale,p):
+    # use gradient filtering to find baselines
+    boxmap = psegutils.compute_boxmap(binary,scale,dtype='B')
+    cleaned = boxmap*binary
+    if p.debugcleaned:
+        figure("debug-cleaned")
+        clf(); title("cleaned"); imshow(cleaned)
+    if p.usegauss:
+        # this uses Gaussians
+        grad = gaussian_filter(cleaned,(p.vscale*0.3*scale,
+                                        p.hscale*6*scale),order=(1,0),output='f')
+    else:
+        # this uses non-Gaussian oriented filters
+        grad = gaussian_filter(cleaned,(max(4,p.vscale*0.3*scale),
+                                        p.hscale*scale),order=(1,0),output='f')
+        grad = uniform_filter(grad,(p.vscale,p.hscale*6*scale))
+    bottom = improc.norm_max((grad<0)*(-grad))
+    top = improc.norm_max((grad>0)*grad)
+    return bottom,top,boxmap
+
+def paint_seeds(bmarked,tmarked,delta,maxdist):
+    """Marks the line seeds given the candidate baselines (`bmarked`)
+    and xheights (`tmarked`).  Going up each column, every baseline
+    pixel is extended upwards by `delta` pixels, and up to the next
+    candidate if that is an xheight less than `maxdist` above it
+    (or the top of the image).  All columns are processed at once."""
+    h,w = bmarked.shape
+    by,bx = nonzero(bmarked)
+    ty,tx = nonzero(tmarked)
+    # sort all candidates by column, then by position in the column, with
+    # an xheight preceding a baseline in the same location; the candidate
+    # preceding a baseline in this order is the next one above it
+    keys = concatenate([bx*(2*h+2)+2*by+1,tx*(2*h+2)+2*ty])
+    keys.sort()
+    xs = keys//(2*h+2)
+    ys = (keys%(2*h+2))//2
+    bottoms = flatnonzero(keys%2==1)
+    x0 = xs[bottoms]
+    y0 = ys[bottoms]
+    prev = bottoms-1
+    valid = (prev>=0)
+    valid[valid] = (xs[prev[valid]]==x0[valid])
+    # use the top of the image if there is no candidate above
+    y1 = where(valid,ys[prev],0)
+    s1 = where(valid,keys[prev]%2,0)
+    # the intervals to be marked, as differences along each column
+    start = y0-delta
+    start = where(start<0,start+h,start) # as for slicing with a negative start
+    start = maximum(start,0)
+    ok1 = (start<y0)
+    ok2 = (s1==0)&(y0-y1<maxdist)&(y1<y0)
+    starts = concatenate([start[ok1]*w+x0[ok1],y1[ok2]*w+x0[ok2]])
+    ends = concatenate([y0[ok1]*w+x0[ok1],y0[ok2]*w+x0[ok2]])
+    marks = bincount(starts,minlength=h*w+w)
+    marks -= bincount(ends,minlength=h*w+w)
+    marks = marks[:h*w].reshape(h,w)
+    ccstats.cumsum_rows(marks)
+    return array(marks>0,'B')
+
+def compute_line_seeds(binary,bottom,top,colseps,scale,p):
+    """Base on gradient maps, computes candidates for baselines
+    and xheights.  Then, it marks the regions between the two
+    as a line seed."""
+    t = p.threshold
+    vrange = int(p.vscale*scale)
+    bmarked = maximum_filter(bottom==maximum_filter(bottom,(vrange,0)),(2,2))
+    bmarked *= (bottom>t*amax(bottom)*t)*(1-colseps)
+    tmarked = maximum_filter(top==maximum_filter(top,(vrange,0)),(2,2))
+    tmarked *= (top>t*amax(top)*t/2)*(1-colseps)
+    tmarked = maximum_filter(tmarked,(1,20))
+    delta = max(3,int(scale/2))
+    seeds = paint_seeds(bmarked,tmarked,delta,5*scale)
+    seeds = maximum_filter(seeds,(1,int(1+scale)))
+    seeds *= (1-colseps)
+    if p.debuglines:
+        figure("debug-lineseeds")
+        common.showrgb(seeds,0.3*tmarked+0.7*bmarked,binary)
+        ginput(1,0.1)
+    seeds,_ = morph.label(seeds)
+    return seeds
+
+
+
+################################################################
+### The complete line segmentation process.
+################################################################
+
+def remove_hlines(binary,scale,maxsize=10):
+    labels,_ = morph.label(binary)
+    objects = morph.find_objects(labels)
+    for i,b in enumerate(objects):
+        if sl.width(b)>maxsize*scale:
+            labels[b][labels[b]==i+1] = 0
+    return array(labels!=0,'B')
+
+def compute_segmentation(binary,scale,p):
+    """Given a binary image, compute a complete segmentation into
+    lines, computing both columns and text lines."""
+    binary = B(binary)
+
+    # start by removing horizontal black lines, which only
+    # interfere with the rest of the page segmentation
+    binary = remove_hlines(binary,scale)
+
+    # do the column finding
+    if not p.quiet: print "computing column separators"
+    colseps,binary = compute_colseps(binary,scale,p)
+
+    # now compute the text line seeds
+    if not p.quiet: print "computing lines"
+    bottom,top,boxmap = compute_gradmaps(binary,scale,p)
+    seeds = compute_line_seeds(binary,bottom,top,colseps,scale,p)
+    if p.debuglines:
+        figure("seeds")
+        common.showrgb(bottom,top,boxmap)
+
+    # spread the text line seeds to all the remaining
+    # components
+    if not p.quiet: print "propagating labels"
+    llabels = morph.propagate_labels(boxmap,seeds,conflict=0)
+    if not p.quiet: print "spreading labels"
+    spread = morph.spread_labels(seeds,maxdist=scale)
+    llabels = where(llabels>0,llabels,spread*binary)
+    segmentation = llabels*binary
+    return segmentation
+
+def segment_page(binary,**kw):
+    """Segment an inverted binary page image (text=1) into text lines.
+    Returns a record with the `scale`, the page `segmentation` (with
+    labels numbered in reading order as 0x010000+i) and the list of
+    `lines` (as computed by `psegutils.compute_lines`) in reading order.
+    Raises RecognitionError if the page can't be segmented.
+    Parameters are as for ocropus-gpageseg (see `defaults`)."""
+    p = params(**kw)
+
+    if p.scale==0:
+        scale = psegutils.estimate_scale(binary)
+    else:
+        scale = p.scale
+    if scale<p.minscale:
+        raise RecognitionError("scale (%g) less than --minscale; skipping"%scale)
+
+    # find columns and text lines
+
+    if not p.quiet: print "computing segmentation"
+    segmentation = compute_segmentation(binary,scale,p)
+    if amax(segmentation)>p.maxlines:
+        raise RecognitionError("too many lines %d"%amax(segmentation))
+    if not p.quiet: print "number of lines",amax(segmentation)
+
+    # compute the reading order
+
+    if not p.quiet: print "finding reading order"
+    lines = psegutils.compute_lines(segmentation,scale)
+    order = psegutils.reading_order([l.bounds for l in lines],debug=p.debugreadingorder)
+    lsort = psegutils.topsort(order)
+
+    # renumber the labels so that they conform to the specs
+
+    nlabels = amax(segmentation)+1
+    renumber = zeros(nlabels,'i')
+    for i,v in enumerate(lsort): renumber[lines[v].label] = 0x010000+(i+1)
+    segmentation = renumber[segmentation]
+    lines = [lines[i] for i in lsort]
+    return Record(scale=scale,segmentation=segmentation,lines=lines)
+
+def extract_lines(binary,lines,grayimage=None,**kw):
+    """Given an inverted binary page image (text=1) and the lines
+    computed by `segment_page`, extract the binary text line images
+    (and grayscale line images if `grayimage` is given).  Returns a list
+    of binary line images and a list of grayscale line images (or None)."""
+    p = params(**kw)
+    cleaned = improc.remove_noise(binary,p.noise)
+    binlines = []
+    graylines = [] if grayimage is not None else None
+    for l in lines:
+        binlines.append(psegutils.extract_masked(1-cleaned,l,pad=p.pad,expand=p.expand))
+        if grayimage is not None:
+            graylines.append(psegutils.extract_masked(grayimage,l,pad=p.pad,expand=p.expand))
+    return binlines,graylines
@@ -15,6 +15,7 @@ if 0:
     from scipy.spatial.distance import cdist
 else:
     from ocrolib.distance import cdist
+from ocrolib import distance
 
 sidenote = "\t\t\t\t\t"
 
@@ -217,7 +218,7 @@ def kmeans(data,k,maxiter=100):
     centers = array(pyrandom.sample(data,k),'f')
     last = -1
     for i in range(maxiter):
-        mins = argmin(cdist(data,centers),axis=1)
+        mins = distance.knn(data,centers,1)[:,0]
         if (mins==last).all(): break
         for i in range(k):
             if sum(mins==i)<1: 
@@ -279,14 +280,10 @@ def pca_kmeans0(data,k,d=0.9,**kw):
 
 @checks(AFLOAT2,AFLOAT2,int,chunksize=RANGE(1,1000000000))
 def knn(data,protos,k,chunksize=1000,threads=-1):
-    result = []
-    for i in range(0,len(data),chunksize):
-        block = data[i:min(i+chunksize,len(data))]
-        if type(block)!=ndarray: block = array(block)
-        ds = cdist(block,protos,threads=threads)
-        js = argsort(ds,axis=1)
-        result.append(js[:,:k])
-    return vstack(result)
+    """Find the indexes of the k nearest prototypes for each row of
+    data, nearest first; see `distance.knn`.  The `chunksize` and `threads`
+    arguments are ignored and only kept for backwards compatibility."""
+    return distance.knn(data,protos,k)
 
 def protosets(nb,k):
     """For a list of nearest neighbors to k prototypes,
@@ -312,6 +309,17 @@ class PcaKmeans:
             pca_kmeans(data,self.k,self.d,min_d=self.min_d,
                        maxiter=self.maxiter,npk=self.npk,verbose=self.verbose)
         self.Pcenters = array(vecsort(self.Pcenters))
+        self.pdists = None
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("pdists",None)
+        return state
+    def dists(self):
+        """Distance computations to the centers (in PCA space); this
+        is cached so that the norms of the centers are computed only once."""
+        if getattr(self,"pdists",None) is None:
+            self.pdists = distance.ProtoDists().setProtos(self.Pcenters)
+        return self.pdists
     def centers(self):
         return dot(self.Pcenters,self.P)+self.mu
     def center(self,i):
@@ -325,22 +333,25 @@ class PcaKmeans:
         # prediction is usually run in parallel for multiple
         # lines)
         y = dot(x.ravel()-self.mu.ravel(),self.P.T)
-        c = knn(y.reshape(1,-1),self.Pcenters,1,threads=threads)
+        c = self.dists().knn(y.reshape(1,-1),1)
         return c[0][0]
-    def predict(self,data,n=0,threads=1):
+    def predict(self,data,n=0,threads=1,chunksize=10000):
         if type(data)==ndarray:
             # regular 2D array code
             data = data.reshape(len(data),-1)
             ys = dot(data-self.mu,self.P.T)
-            nb = knn(ys,self.Pcenters,max(1,n),threads=threads)
+            nb = self.dists().knn(ys,max(1,n))
         else:
-            # for datasets (and other iterables), use a slower, per-row routine
+            # for datasets (and other iterables), project and
+            # classify `chunksize` rows at a time
             nb = []
-            for i,x in enumerate(data):
-                if self.verbose:
-                    if i%100000==0: print sidenote+"PcaKmeans.predict",i
-                nb.append(self.predict1(x))
-            nb = array(nb)
+            for i in range(0,len(data),chunksize):
+                if self.verbose: print sidenote+"PcaKmeans.predict",i
+                block = data[i:min(i+chunksize,len(data))]
+                block = array([asarray(x).ravel() for x in block])
+                ys = dot(block-self.mu.ravel(),self.P.T)
+                nb.append(self.dists().knn(ys,max(1,n)))
+            nb = vstack(nb) if len(nb)>0 else zeros((0,max(1,n)),'i')
         if n==0:
             return nb[:,0]
         else:
@@ -412,8 +423,37 @@ class HierarchicalSplitter:
         else:
             if self.subs[s] is None: return -1
             return self.subs[s].predict1(v)
-    def predict(self,data):
-        return array([self.predict1(v) for v in data],'i')
+    def predict(self,data,chunksize=10000):
+        """Compute the bucket numbers for a 2D array, list of vectors,
+        or Dataset.  The data is processed `chunksize` vectors at a time
+        using `predict_batch`."""
+        result = [zeros(0,'i')]
+        for i in range(0,len(data),chunksize):
+            block = data[i:min(i+chunksize,len(data))]
+            result.append(self.predict_batch(block))
+        return concatenate(result)
+    def predict_batch(self,data):
+        """Compute the bucket numbers for a list (or 2D array) of vectors
+        that fits into memory.  The tree is traversed level by level: each node
+        projects all the vectors that reach it at once, assigns them to its
+        children with a single distance computation, and passes each group
+        of vectors on to the corresponding child."""
+        if "extractor" in dir(self) and self.extractor is not None:
+            data = [self.extractor(v) for v in data]
+        result = zeros(len(data),'i')
+        if len(data)==0: return result
+        if type(data)==ndarray:
+            data = data.reshape(len(data),-1)
+        else:
+            data = array([asarray(v).ravel() for v in data])
+        buckets = self.splitter.predict(data)
+        for s in set(buckets):
+            rows = nonzero(buckets==s)[0]
+            if self.subs[s] is None:
+                result[rows] = self.offsets[s]
+            else:
+                result[rows] = self.subs[s].predict_batch(data[rows])
+        return result
     def nclusters(self):
         return self.offsets[-1]
     def center(self,v):
@@ -440,6 +480,8 @@ class TrivialCmodel:
     def coutputs(self,v):
         n = sum(self.counter.values())
         return [(k,c*1.0/n) for k,n in self.counter.most_common(self.limit)]
+    def coutputs_batch(self,vs,geometries=None):
+        return [self.coutputs(v) for v in vs]
 
 class TrivialCostModel:
     """Here, cost is simply Euclidean distance from the mean of the bucket.
@@ -481,6 +523,13 @@ class LogisticCmodel:
         pred = dot(v,self.R.T)+self.r
         if not self.linear: pred = mlinear.sigmoid(pred)
         return sorted(zip(self.reverse,pred),key=lambda x:-x[1])
+    def coutputs_batch(self,vs,geometries=None):
+        """Compute the outputs for a list (or 2D array) of vectors
+        with a single matrix product."""
+        if len(vs)==0: return []
+        preds = dot(make2d(array(vs)),self.R.T)+self.r
+        if not self.linear: preds = mlinear.sigmoid(preds)
+        return [sorted(zip(self.reverse,pred),key=lambda x:-x[1]) for pred in preds]
 
 # obsolete, just for backwards compatibility
 
@@ -519,6 +568,30 @@ class LocalCmodel:
         if i<0: return []
         if self.cmodels[i] is None: return []
         return self.cmodels[i].coutputs(v,geometry=geometry)
+    def coutputs_batch(self,vs,geometries=None):
+        """Compute the outputs for a list of vectors (e.g., all the
+        character candidates of a text line) at once.  The vectors are
+        routed through the splitter together, and each bucket classifier
+        is called once with all the vectors that fall into its bucket.
+        The result is the same as calling `coutputs` on each vector."""
+        vs = [v.ravel() for v in vs]
+        if geometries is None: geometries = [None]*len(vs)
+        for v in vs:
+            if self.cshape is None: self.cshape=v.shape
+            else: assert self.cshape==v.shape
+        result = [[] for v in vs]
+        if len(vs)==0: return result
+        buckets = self.splitter.predict_batch(array(vs))
+        for i in set(buckets):
+            if i<0 or self.cmodels[i] is None: continue
+            rows = nonzero(buckets==i)[0]
+            cmodel = self.cmodels[i]
+            if hasattr(cmodel,"coutputs_batch"):
+                outputs = cmodel.coutputs_batch(array([vs[j] for j in rows]),[geometries[j] for j in rows])
+            else:
+                outputs = [cmodel.coutputs(vs[j],geometry=geometries[j]) for j in rows]
+            for j,o in zip(rows,outputs): result[j] = o
+        return result
 
 
 
@@ -531,7 +604,12 @@ class ModelWithExtractor:
         self.model.fit(transformed,classes)
     def coutputs(self,v,geometry=None,prenormalized=0):
         transformed = self.extractor(v)
-        return self.coutputs(transformed)
+        return self.model.coutputs(transformed)
+    def coutputs_batch(self,vs,geometries=None,prenormalized=0):
+        transformed = [self.extractor(v) for v in vs]
+        if hasattr(self.model,"coutputs_batch"):
+            return self.model.coutputs_batch(transformed,geometries)
+        return [self.model.coutputs(v) for v in transformed]
 
 class Extractor0:
     def __init__(self,alpha=0.5,dsigma=1.0,spread=0,tsize=(32,32)):
@@ -651,26 +729,95 @@ def datachunks(data,model=None,chunksize=1000):
         if type(block)!=ndarray: block = array(block,'float32')
         yield i,j,block,model
 
-def coutputs_chunk(job):
-    i,j,block,model = job
-    outputs = [model.coutputs(v) for v in block]
-    return i,j,outputs
-
-def parallel_coutputs(model,data,parallel=multiprocessing.cpu_count(),verbose=1):
-    results = [None]*len(data)
-    for i,j,outs in common.parallel_map(coutputs_chunk,datachunks(data,model=model),parallel=parallel):
-        if verbose: print "parallel_coutputs",i,j,"(%d)"%parallel
-        for k in range(j-i): results[i+k] = outs[k]
-    return results
-
-def predict_chunk(job):
-    i,j,block,model = job
-    return i,j,model.predict(block)
-
-def parallel_predict(model,data,parallel=multiprocessing.cpu_count(),verbose=1):
-    results = [None]*len(data)
-    for i,j,outs in common.parallel_map(predict_chunk,datachunks(data,model=model),parallel=parallel):
-        if verbose: print "parallel_predict",i,j,"(%d)"%parallel
-        for k in range(j-i): results[i+k] = outs[k]
-    return results
+# The worker processes of a ModelPool receive the model (and optionally
+# a data array) once, when they are forked, and keep them in these globals.
+
+pool_model = None
+pool_data = None
+
+def pool_init(model,data):
+    global pool_model,pool_data
+    pool_model = model
+    pool_data = data
+
+def pool_block(i,j,block):
+    if block is None: block = pool_data[i:j]
+    if type(block)!=ndarray: block = array(block,'float32')
+    return block
+
+def pool_predict(job):
+    i,j,block = job
+    return i,j,pool_model.predict(pool_block(i,j,block))
+
+def pool_coutputs(job):
+    i,j,block = job
+    return i,j,[pool_model.coutputs(v) for v in pool_block(i,j,block)]
+
+class ModelPool:
+    """A pool of worker processes for applying a model to large amounts
+    of data.  The model is passed to the workers only once (when they are
+    started), and so is `data`, if given; jobs for that array only contain
+    the range of rows (this works for memory mapped arrays, too).  Other
+    data is sent to the workers in chunks.  The pool can be used for any
+    number of calls; call `close` when done."""
+    def __init__(self,model,parallel=multiprocessing.cpu_count(),data=None,chunksize=1000):
+        self.model = model
+        self.data = data
+        self.parallel = parallel
+        self.chunksize = chunksize
+        self.pool = multiprocessing.Pool(parallel,initializer=pool_init,initargs=(model,data))
+    def jobs(self,data):
+        shared = (data is self.data)
+        for i in range(0,len(data),self.chunksize):
+            j = min(i+self.chunksize,len(data))
+            yield i,j,(None if shared else data[i:j])
+    def predict(self,data,verbose=0):
+        """Compute `model.predict` for all the rows of `data`; returns an array."""
+        results = zeros(len(data),'i')
+        for i,j,outs in self.pool.imap_unordered(pool_predict,self.jobs(data)):
+            if verbose: print "parallel_predict",i,j,"(%d)"%self.parallel
+            results[i:j] = outs
+        return results
+    def coutputs(self,data,verbose=0):
+        """Compute `model.coutputs` for each row of `data`; returns a list."""
+        results = [None]*len(data)
+        for i,j,outs in self.pool.imap_unordered(pool_coutputs,self.jobs(data)):
+            if verbose: print "parallel_coutputs",i,j,"(%d)"%self.parallel
+            results[i:j] = outs
+        return results
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def parallel_coutputs(model,data,parallel=multiprocessing.cpu_count(),verbose=1,pool=None):
+    """Compute `model.coutputs` for each row of `data` in parallel.
+    The computation uses `pool` (a ModelPool for `model`) if given."""
+    if pool is not None: return pool.coutputs(data,verbose=verbose)
+    if parallel<2:
+        results = []
+        for i,j,block,_ in datachunks(data):
+            if verbose: print "parallel_coutputs",i,j,"(%d)"%parallel
+            results += [model.coutputs(v) for v in block]
+        return results
+    pool = ModelPool(model,parallel=parallel,data=data)
+    try:
+        return pool.coutputs(data,verbose=verbose)
+    finally:
+        pool.close()
+
+def parallel_predict(model,data,parallel=multiprocessing.cpu_count(),verbose=1,pool=None):
+    """Compute `model.predict` for the rows of `data` in parallel.
+    The computation uses `pool` (a ModelPool for `model`) if given."""
+    if pool is not None: return list(pool.predict(data,verbose=verbose))
+    if parallel<2:
+        results = []
+        for i,j,block,_ in datachunks(data):
+            if verbose: print "parallel_predict",i,j,"(%d)"%parallel
+            results += list(model.predict(block))
+        return results
+    pool = ModelPool(model,parallel=parallel,data=data)
+    try:
+        return list(pool.predict(data,verbose=verbose))
+    finally:
+        pool.close()
 
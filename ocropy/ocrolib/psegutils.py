@@ -5,7 +5,7 @@ import argparse,glob,os,os.path
 from scipy.ndimage import filters,interpolation,morphology,measurements
 from scipy import stats
 from scipy.misc import imsave
-import common,sl,morph
+import common,sl,morph,ccstats
 
 def B(a):
     if a.dtype==dtype('B'): return a
@@ -42,23 +42,26 @@ def binary_objects(binary):
     return objects
 
 def estimate_scale(binary):
-    objects = binary_objects(binary)
-    bysize = sorted(objects,key=sl.area)
-    scalemap = zeros(binary.shape)
-    for o in bysize:
-        if amax(scalemap[o])>0: continue
-        scalemap[o] = sl.area(o)**0.5
-    scale = median(scalemap[(scalemap>3)&(scalemap<100)])
+    """Estimate the scale (roughly, the xheight) as the median of the
+    square roots of the bounding box areas of the connected components,
+    weighted by area.  Components are taken by increasing size, skipping
+    those whose box overlaps the box of a component already taken."""
+    stats = ccstats.binary_stats(binary)
+    kept = ccstats.disjoint_boxes(stats)
+    sizes = stats.areas[kept]**0.5
+    scales = repeat(sizes,stats.areas[kept])
+    scale = median(scales[(scales>3)&(scales<100)])
     return scale
 
 def compute_boxmap(binary,scale,threshold=(.5,4),dtype='i'):
-    objects = binary_objects(binary)
-    bysize = sorted(objects,key=sl.area)
-    boxmap = zeros(binary.shape,dtype)
-    for o in bysize:
-        if sl.area(o)**.5<threshold[0]*scale: continue
-        if sl.area(o)**.5>threshold[1]*scale: continue
-        boxmap[o] = 1
+    """Mark the bounding boxes of the connected components whose size
+    (square root of the box area) is between `threshold[0]*scale`
+    and `threshold[1]*scale`."""
+    stats = ccstats.binary_stats(binary)
+    sizes = stats.areas**.5
+    which = find((sizes>=threshold[0]*scale)&(sizes<=threshold[1]*scale))
+    which = which[which>0]
+    boxmap = array(ccstats.box_coverage(stats,which)>0,dtype)
     return boxmap
 
 def compute_lines(segmentation,scale):
@@ -122,54 +125,68 @@ def reading_order(lines,highlight=None,debug=0):
     """Given the list of lines (a list of 2D slices), computes
     the partial reading order.  The output is a binary 2D array
     such that order[i,j] is true if line i comes before line j
-    in reading order."""
-    order = zeros((len(lines),len(lines)),'B')
-    def x_overlaps(u,v):
-        return u[1].start<v[1].stop and u[1].stop>v[1].start
-    def above(u,v):
-        return u[0].start<v[0].start
-    def left_of(u,v):
-        return u[1].stop<v[1].start
-    def separates(w,u,v):
-        if w[0].stop<min(u[0].start,v[0].start): return 0
-        if w[0].start>max(u[0].stop,v[0].stop): return 0
-        if w[1].start<u[1].stop and w[1].stop>v[1].start: return 1
-    if highlight is not None:
-        clf(); title("highlight"); imshow(binary); ginput(1,debug)
-    for i,u in enumerate(lines):
-        for j,v in enumerate(lines):
-            if x_overlaps(u,v):
-                if above(u,v):
-                    order[i,j] = 1
-            else:
-                if [w for w in lines if separates(w,u,v)]==[]:
-                    if left_of(u,v): order[i,j] = 1
-            if j==highlight and order[i,j]:
-                print (i,j),
-                y0,x0 = sl.center(lines[i])
-                y1,x1 = sl.center(lines[j])
-                plot([x0,x1+200],[y0,y1])
+    in reading order.
+
+    Lines that overlap horizontally are ordered top to bottom.  Otherwise,
+    line i comes before line j if it is to the left of it and no line
+    separates them, that is, no line spans the gap between them and
+    overlaps them vertically.  A separator must contain the right edge of
+    line i, so for each line, only the (usually few) lines crossing its
+    right edge need to be checked, instead of all the lines for all
+    pairs."""
+    n = len(lines)
+    y0,x0,y1,x1 = [array([f(l) for l in lines],'i').reshape(n) for f in
+                   (lambda l:l[0].start,lambda l:l[1].start,lambda l:l[0].stop,lambda l:l[1].stop)]
+    xoverlaps = (x0[:,newaxis]<x1[newaxis,:])&(x1[:,newaxis]>x0[newaxis,:])
+    order = array(xoverlaps&(y0[:,newaxis]<y0[newaxis,:]),'B')
+    # lines sorted by their left edge, for finding the lines to the right
+    byleft = argsort(x0,kind='mergesort')
+    for i in range(n):
+        right = byleft[searchsorted(x0[byleft],x1[i],'right'):]
+        if len(right)==0: continue
+        seps = find((x0<x1[i])&(x1>x1[i]))
+        seps = seps[x1[seps]>amin(x0[right])]
+        if len(seps)>0:
+            ylo = minimum(y0[i],y0[right])[:,newaxis]
+            yhi = maximum(y1[i],y1[right])[:,newaxis]
+            separated = (x1[seps][newaxis,:]>x0[right][:,newaxis])
+            separated &= (y1[seps][newaxis,:]>=ylo)&(y0[seps][newaxis,:]<=yhi)
+            right = right[~separated.any(axis=1)]
+        order[i,right] = 1
     if highlight is not None:
+        clf(); title("highlight")
+        for i in find(order[:,highlight]):
+            print (i,highlight),
+            ya,xa = sl.center(lines[i])
+            yb,xb = sl.center(lines[highlight])
+            plot([xa,xb+200],[ya,yb])
         print
         ginput(1,debug)
     return order
 
 def topsort(order):
     """Given a binary array defining a partial order (o[i,j]==True means i<j),
-    compute a topological sort.  This is a quick and dirty implementation
-    that works for up to a few thousand elements."""
+    compute a topological sort.  This is a depth first search that visits
+    the predecessors of each element in order; it uses an explicit stack,
+    so it works for any number of elements."""
     n = len(order)
-    visited = zeros(n)
+    visited = zeros(n,bool)
     L = []
-    def visit(k):
-        if visited[k]: return
-        visited[k] = 1
-        for l in find(order[:,k]):
-            visit(l)
-        L.append(k)
     for k in range(n):
-        visit(k)
-    return L #[::-1]
+        if visited[k]: continue
+        visited[k] = 1
+        stack = [(k,iter(find(order[:,k])))]
+        while len(stack)>0:
+            l,preds = stack[-1]
+            for m in preds:
+                if not visited[m]:
+                    visited[m] = 1
+                    stack.append((m,iter(find(order[:,m]))))
+                    break
+            else:
+                stack.pop()
+                L.append(l)
+    return L
 
 def show_lines(image,lines,lsort):
     """Overlays the computed lines on top of the image, for debugging